@@ -1,4 +1,5 @@
-from models import SQLModel
+from sqlmodel import SQLModel
+import main  # noqa: F401  registers the table models on SQLModel.metadata
 from sqlalchemy import create_engine, pool
 from alembic import context
 
@@ -0,0 +1,31 @@
+"""note (owner_id, id) index for keyset pagination
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0001'
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # databases built by the app's create_all already have it
+    indexes = {index['name'] for index in sa.inspect(op.get_bind()).get_indexes('note')}
+    if 'ix_note_owner_id_id' not in indexes:
+        op.create_index('ix_note_owner_id_id', 'note', ['owner_id', 'id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_note_owner_id_id', table_name='note')
@@ -0,0 +1,72 @@
+"""note full-text search index
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, Sequence[str], None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    if op.get_bind().dialect.name == 'postgresql':
+        # stored generated column, so every insert/update keeps it in sync;
+        # the app's ensure_search_index may have created both already
+        op.execute(
+            """
+            ALTER TABLE note ADD COLUMN IF NOT EXISTS search_vector tsvector
+            GENERATED ALWAYS AS (
+                setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+                setweight(to_tsvector('simple', coalesce(content, '')), 'B')
+            ) STORED
+            """
+        )
+        op.execute("CREATE INDEX IF NOT EXISTS ix_note_search_vector ON note USING gin (search_vector)")
+    elif op.get_bind().dialect.name == 'sqlite':
+        op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS note_fts USING fts5(title, content, content='note', content_rowid='id')")
+        op.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS note_fts_ai AFTER INSERT ON note BEGIN
+                INSERT INTO note_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+            END
+            """
+        )
+        op.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS note_fts_ad AFTER DELETE ON note BEGIN
+                INSERT INTO note_fts(note_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+            END
+            """
+        )
+        op.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS note_fts_au AFTER UPDATE ON note BEGIN
+                INSERT INTO note_fts(note_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+                INSERT INTO note_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+            END
+            """
+        )
+        op.execute("INSERT INTO note_fts(note_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_note_search_vector', table_name='note')
+        op.drop_column('note', 'search_vector')
+    elif op.get_bind().dialect.name == 'sqlite':
+        op.execute("DROP TRIGGER IF EXISTS note_fts_au")
+        op.execute("DROP TRIGGER IF EXISTS note_fts_ad")
+        op.execute("DROP TRIGGER IF EXISTS note_fts_ai")
+        op.execute("DROP TABLE IF EXISTS note_fts")
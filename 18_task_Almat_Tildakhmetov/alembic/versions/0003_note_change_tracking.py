@@ -0,0 +1,108 @@
+"""note change tracking for delta sync
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003'
+down_revision: Union[str, Sequence[str], None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# batch mode rebuilds note on SQLite, which drops the FTS triggers from 0002
+NOTE_FTS_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS note_fts_ai AFTER INSERT ON note BEGIN
+        INSERT INTO note_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS note_fts_ad AFTER DELETE ON note BEGIN
+        INSERT INTO note_fts(note_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS note_fts_au AFTER UPDATE ON note BEGIN
+        INSERT INTO note_fts(note_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO note_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END
+    """,
+]
+
+
+def restore_fts_triggers() -> None:
+    bind = op.get_bind()
+    if bind.dialect.name != 'sqlite' or 'note_fts' not in sa.inspect(bind).get_table_names():
+        return
+    for statement in NOTE_FTS_TRIGGERS:
+        op.execute(statement)
+    op.execute("INSERT INTO note_fts(note_fts) VALUES ('rebuild')")
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # the app's create_all may have built any of this already; skip what exists
+    inspector = sa.inspect(op.get_bind())
+    tables = set(inspector.get_table_names())
+    note_columns = {column['name'] for column in inspector.get_columns('note')}
+    note_indexes = {index['name'] for index in inspector.get_indexes('note')}
+
+    if 'note_sequence' not in tables:
+        op.create_table(
+            'note_sequence',
+            sa.Column('owner_id', sa.Integer(), primary_key=True),
+            sa.Column('value', sa.Integer(), nullable=False),
+        )
+    if 'note_tombstone' not in tables:
+        op.create_table(
+            'note_tombstone',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('owner_id', sa.Integer(), nullable=False),
+            sa.Column('note_id', sa.Integer(), nullable=False),
+            sa.Column('seq', sa.Integer(), nullable=False),
+            sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=False),
+        )
+        op.create_index('ix_note_tombstone_owner_id_seq', 'note_tombstone', ['owner_id', 'seq'])
+
+    if 'seq' in note_columns:
+        # the app already numbers these notes; renumbering would break its counters
+        if 'ix_note_owner_id_seq' not in note_indexes:
+            op.create_index('ix_note_owner_id_seq', 'note', ['owner_id', 'seq'])
+        return
+
+    with op.batch_alter_table('note') as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()))
+        batch_op.add_column(sa.Column('seq', sa.Integer(), nullable=False, server_default='0'))
+    op.create_index('ix_note_owner_id_seq', 'note', ['owner_id', 'seq'])
+
+    # number existing notes 1..n per owner in id order and start each counter after them
+    op.execute(
+        """
+        UPDATE note SET seq = (
+            SELECT count(*) FROM note AS earlier
+            WHERE earlier.owner_id = note.owner_id AND earlier.id <= note.id
+        )
+        """
+    )
+    op.execute("INSERT INTO note_sequence (owner_id, value) SELECT owner_id, max(seq) FROM note GROUP BY owner_id")
+    restore_fts_triggers()
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_note_tombstone_owner_id_seq', table_name='note_tombstone')
+    op.drop_table('note_tombstone')
+    op.drop_table('note_sequence')
+    op.drop_index('ix_note_owner_id_seq', table_name='note')
+    with op.batch_alter_table('note') as batch_op:
+        batch_op.drop_column('seq')
+        batch_op.drop_column('updated_at')
+    restore_fts_triggers()
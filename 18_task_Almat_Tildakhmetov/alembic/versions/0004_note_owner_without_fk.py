@@ -0,0 +1,34 @@
+"""drop note.owner_id foreign key for sharded notes
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004'
+down_revision: Union[str, Sequence[str], None] = '0003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # notes can move to shards that don't have the user table; SQLite doesn't enforce it by default
+    if op.get_bind().dialect.name == 'postgresql':
+        # a note table built by the app's create_all never had it
+        foreign_keys = {fk['name'] for fk in sa.inspect(op.get_bind()).get_foreign_keys('note')}
+        if 'note_owner_id_fkey' in foreign_keys:
+            op.drop_constraint('note_owner_id_fkey', 'note', type_='foreignkey')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name == 'postgresql':
+        op.create_foreign_key('note_owner_id_fkey', 'note', 'user', ['owner_id'], ['id'])
@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+from prometheus_client import Counter
+
+from config import settings
+from redis_client import get_redis
+
+AUTH_CACHE_HITS = Counter("auth_cache_hits_total", "Authenticated principal cache hits", ["tier"])
+AUTH_CACHE_MISSES = Counter("auth_cache_misses_total", "Authenticated principal cache misses")
+
+AUTH_INVALIDATION_CHANNEL = "auth:invalidate"
+
+
+def token_fingerprint(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class PrincipalCache:
+    def __init__(self, maxsize: int, ttl: int):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._by_user: dict[int, set[str]] = {}
+        # user id -> when it was last invalidated (time.time()), so a request that
+        # read the user before that can't put the old principal back
+        self._invalidated: dict[int, float] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def _drop(self, fingerprint: str):
+        _, principal = self._entries.pop(fingerprint)
+        fingerprints = self._by_user.get(principal["id"])
+        if fingerprints is not None:
+            fingerprints.discard(fingerprint)
+            if not fingerprints:
+                del self._by_user[principal["id"]]
+
+    def _get_local(self, fingerprint: str) -> dict | None:
+        entry = self._entries.get(fingerprint)
+        if entry is None:
+            return None
+        expires_at, principal = entry
+        if expires_at <= time.time():
+            self._drop(fingerprint)
+            return None
+        self._entries.move_to_end(fingerprint)
+        return principal
+
+    def _set_local(self, fingerprint: str, principal: dict, expires_at: float):
+        if fingerprint in self._entries:
+            self._drop(fingerprint)
+        self._entries[fingerprint] = (expires_at, principal)
+        self._by_user.setdefault(principal["id"], set()).add(fingerprint)
+        while len(self._entries) > self.maxsize:
+            self._drop(next(iter(self._entries)))
+
+    async def get(self, fingerprint: str) -> dict | None:
+        principal = self._get_local(fingerprint)
+        if principal is not None:
+            AUTH_CACHE_HITS.labels(tier="local").inc()
+            return principal
+
+        if settings.AUTH_CACHE_REDIS:
+            redis = await get_redis()
+            raw = await redis.get(f"auth:principal:{fingerprint}")
+            if raw:
+                data = json.loads(raw)
+                self._set_local(fingerprint, data["principal"], data["expires_at"])
+                AUTH_CACHE_HITS.labels(tier="redis").inc()
+                return data["principal"]
+
+        AUTH_CACHE_MISSES.inc()
+        return None
+
+    async def set(self, fingerprint: str, principal: dict, token_exp: float, read_at: float):
+        if self._invalidated.get(principal["id"], 0) >= read_at:
+            return
+        # never keep a principal past the token's own expiry
+        expires_at = min(time.time() + self.ttl, token_exp)
+        ttl = int(expires_at - time.time())
+        if ttl <= 0:
+            return
+        self._set_local(fingerprint, principal, expires_at)
+
+        if settings.AUTH_CACHE_REDIS:
+            redis = await get_redis()
+            user_key = f"auth:user:{principal['id']}"
+            pipe = redis.pipeline()
+            pipe.set(f"auth:principal:{fingerprint}", json.dumps({"principal": principal, "expires_at": expires_at}), ex=ttl)
+            pipe.sadd(user_key, fingerprint)
+            pipe.expire(user_key, settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+            await pipe.execute()
+
+    def invalidate_user_local(self, user_id: int):
+        now = time.time()
+        self._invalidated[user_id] = now
+        if len(self._invalidated) > self.maxsize:
+            # a request reads its user well within the ttl
+            for key in [key for key, at in self._invalidated.items() if at < now - self.ttl]:
+                del self._invalidated[key]
+        for fingerprint in list(self._by_user.get(user_id, ())):
+            self._drop(fingerprint)
+
+    def clear(self):
+        self._entries.clear()
+        self._by_user.clear()
+
+    async def invalidate_user(self, user_id: int):
+        self.invalidate_user_local(user_id)
+        redis = await get_redis()
+        if settings.AUTH_CACHE_REDIS:
+            user_key = f"auth:user:{user_id}"
+            fingerprints = await redis.smembers(user_key)
+            keys = [f"auth:principal:{fp}" for fp in fingerprints]
+            await redis.delete(user_key, *keys)
+        # the other workers drop their local copies in listen_for_user_invalidations
+        await redis.publish(AUTH_INVALIDATION_CHANNEL, user_id)
+
+    def invalidate_user_nowait(self, user_id: int):
+        # usable from sync code such as ORM event hooks
+        self.invalidate_user_local(user_id)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        # the loop only keeps a weak reference to its tasks
+        task = loop.create_task(self.invalidate_user(user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._invalidation_done)
+
+    def _invalidation_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Redis error in auth cache invalidation: {task.exception()}")
+
+
+principal_cache = PrincipalCache(settings.AUTH_CACHE_SIZE, settings.AUTH_CACHE_TTL)
+
+
+async def listen_for_user_invalidations():
+    # a role or password change on one worker must not leave the old principal cached on the others
+    while True:
+        try:
+            pubsub = (await get_redis()).pubsub()
+            await pubsub.subscribe(AUTH_INVALIDATION_CHANNEL)
+            # anything published while we were disconnected is lost
+            principal_cache.clear()
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    principal_cache.invalidate_user_local(int(message["data"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Redis error in auth invalidation listener: {e}")
+            principal_cache.clear()
+            await asyncio.sleep(1)
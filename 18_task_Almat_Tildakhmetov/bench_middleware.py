@@ -0,0 +1,157 @@
+# Before/after benchmark for the request middleware (RateLimit + request logging).
+#
+#   python bench_middleware.py
+#   python bench_middleware.py -n 50000
+#
+# "before" replays the BaseHTTPMiddleware RateLimit and the @app.middleware("http")
+# log_requests; "after" is the plain ASGI mw.RateLimit and mw.RequestLogging, stacked
+# in the same order as main.app. Both charge the same local token buckets with the
+# redis sync pushed out of the run, so the numbers are middleware overhead only.
+# Requests are fed straight into the ASGI app, no server or HTTP client.
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+os.environ.setdefault("CELERY_BROKER_URL", "redis://localhost:6379/0")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+os.environ.setdefault("RATE_LIMIT_MODE", "local")
+os.environ.setdefault("RATE_LIMIT_SYNC_INTERVAL_MS", str(3600 * 1000))
+os.environ.setdefault("RATE_LIMIT_LOCAL_OVERSHOOT", str(10 ** 9))
+os.environ.setdefault("RATE_LIMIT_REQUESTS", str(10 ** 9))
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from pythonjsonlogger import jsonlogger
+from starlette.middleware.base import BaseHTTPMiddleware
+
+import mw
+from config import settings
+
+# same policy table, but no budget runs out during the run
+settings.RATE_LIMIT_POLICIES = [policy.model_copy(update={"limit": None}) for policy in settings.RATE_LIMIT_POLICIES]
+
+logger = logging.getLogger("bench_middleware")
+handler = logging.StreamHandler(open(os.devnull, "w"))
+handler.setFormatter(jsonlogger.JsonFormatter())
+logger.handlers = [handler]
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+
+def build_routes(app: FastAPI):
+    @app.get("/health")
+    def health():
+        return {"status": "ok"}
+
+    @app.get("/notes/notes")
+    async def notes():
+        return [{"id": 1, "title": "t", "content": "c", "owner_id": 1}]
+
+    @app.get("/notes/export")
+    async def export():
+        async def body():
+            for _ in range(20):
+                yield b'{"id":1,"title":"t","content":"c","owner_id":1}\n'
+        return StreamingResponse(body(), media_type="application/x-ndjson")
+
+
+class LegacyRateLimit(BaseHTTPMiddleware):
+    # the previous dispatch, on top of the same policies and limiters
+    def __init__(self, app):
+        super().__init__(app)
+        self.limits = mw.RateLimit(None, skip_paths=[])
+
+    async def dispatch(self, request: Request, call_next):
+        policy = mw.match_policy(self.limits.policies, request.method, request.url.path, set(request.query_params))
+        limiter = self.limits.get_limiter(policy)
+        allowed, remaining, retry_ms = await limiter.hit(self.limits.client_key(request.scope, policy), policy.cost)
+        response = await call_next(request)
+        response.headers.update({"X-RateLimit-Limit": str(limiter.limit), "X-RateLimit-Remaining": str(remaining), "X-RateLimit-Policy": policy.name})
+        return response
+
+
+def bare_app():
+    app = FastAPI()
+    build_routes(app)
+    return app
+
+
+def before_app():
+    app = FastAPI()
+    app.add_middleware(LegacyRateLimit)
+
+    @app.middleware("http")
+    async def log_requests(request: Request, call_next):
+        logger.info({"event": "request_start", "method": request.method, "url": str(request.url)})
+        response = await call_next(request)
+        logger.info({"event": "request_end", "status_code": response.status_code})
+        return response
+
+    build_routes(app)
+    return app
+
+
+def after_app():
+    app = FastAPI()
+    app.add_middleware(mw.RateLimit)
+    app.add_middleware(mw.RequestLogging, logger=logger)
+    build_routes(app)
+    return app
+
+
+async def request(app, path: str):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"",
+        "headers": [(b"host", b"bench")], "client": ("127.0.0.1", 1234), "server": ("bench", 80),
+    }
+    status = None
+    received = False
+
+    async def receive():
+        nonlocal received
+        if received:
+            # like a server: nothing more arrives until the client disconnects
+            await asyncio.Event().wait()
+        received = True
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    assert status == 200, status
+
+
+async def run(n: int):
+    apps = {"bare": bare_app(), "before": before_app(), "after": after_app()}
+    results = {}
+    for path in ("/notes/notes", "/notes/export", "/health"):
+        for label, app in apps.items():
+            for _ in range(200):
+                await request(app, path)
+            started = time.perf_counter()
+            for _ in range(n):
+                await request(app, path)
+            results[path, label] = (time.perf_counter() - started) / n * 1e6
+
+    for path in ("/notes/notes", "/notes/export", "/health"):
+        bare = results[path, "bare"]
+        for label in ("bare", "before", "after"):
+            us = results[path, label]
+            print(f"{path:<15}{label:<8}{us:>9.1f} us/req {us - bare:>+9.1f} us middleware")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=20000)
+    args = parser.parse_args()
+    asyncio.run(run(args.n))
+
+
+if __name__ == "__main__":
+    main()
@@ -15,3 +15,33 @@ def send_email_task(email: str):
     time.sleep(5)
     print(f"Email sent to {email}")
     return f"Email sent to {email}"
+
+
+@celery.task
+def import_notes_task(path: str, fmt: str, owner_id: int):
+    import os
+    import redis
+    from sqlmodel import Session
+    from shards import note_shards
+    from note_import import run_import
+    from redis_client import notes_generation_key, notes_generation_base, note_cache_key, INVALIDATION_CHANNEL
+
+    client = redis.Redis.from_url(settings.REDIS_URL)
+
+    def drop_negative_entries(note_ids):
+        # ids looked up before they existed may be cached as 404s
+        client.delete(*(note_cache_key(owner_id, note_id) for note_id in note_ids))
+
+    try:
+        with open(path, "rb") as stream, Session(note_shards.engine(owner_id)) as session:
+            report = run_import(session, stream, fmt, owner_id, settings.NOTES_IMPORT_BATCH_SIZE, settings.NOTES_IMPORT_MAX_ERRORS, drop_negative_entries)
+    finally:
+        os.remove(path)
+
+    # invalidate the owner's notes cache once for the whole import
+    pipe = client.pipeline()
+    pipe.set(notes_generation_key(owner_id), notes_generation_base(), nx=True)
+    pipe.incr(notes_generation_key(owner_id))
+    pipe.publish(INVALIDATION_CHANNEL, owner_id)
+    pipe.execute()
+    return report
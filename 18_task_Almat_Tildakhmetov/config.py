@@ -1,5 +1,20 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from functools import lru_cache
+from pydantic import BaseModel
+from typing import Literal
+
+class RateLimitPolicy(BaseModel):
+    # requests matching path (fnmatch pattern), method and query parameters are charged
+    # `cost` units from their own budget, counted per client ip, per token sub or globally
+    name: str
+    path: str
+    methods: list[str] = ["*"]
+    query: list[str] = []
+    cost: int = 1
+    scope: Literal["ip", "sub", "global"] = "ip"
+    # units per window; default to RATE_LIMIT_REQUESTS / RATE_LIMIT_WINDOW
+    limit: int | None = None
+    window: int | None = None
 
 class Settings(BaseSettings):
     DATABASE_URL: str = "sqlite:///./test.db"
@@ -7,9 +22,92 @@ class Settings(BaseSettings):
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
 
+    # database pool (asyncpg for postgres, aiosqlite for sqlite)
+    DB_ECHO: bool = True
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_PRE_PING: bool = True
+    DB_POOL_RECYCLE: int = 1800
+
+    # read-only handlers are routed to these; empty means everything uses the primary
+    DATABASE_REPLICA_URLS: list[str] = []
+    DB_REPLICA_HEALTH_INTERVAL: int = 5
+    DB_REPLICA_HEALTH_TIMEOUT: int = 2
+    DB_READ_YOUR_WRITES_SECONDS: int = 5
+
+    # notes are spread over these by jump hash of owner_id; empty means they live in DATABASE_URL.
+    # only append new shards, then run rebalance_shards.py
+    NOTES_SHARD_URLS: list[str] = []
+    NOTES_SHARD_ID_SPAN: int = 100_000_000
+
     CELERY_BROKER_URL: str
     REDIS_URL: str
 
+    # requests to these paths bypass the logging and rate limit middleware
+    MIDDLEWARE_SKIP_PATHS: list[str] = ["/health", "/metrics"]
+
+    # adaptive in-flight limit enforced by mw.ConcurrencyLimit; requests over it get a 503.
+    # a class may only use its share of the limit, so auth (bcrypt) is shed first and reads last
+    CONCURRENCY_LIMIT_ENABLED: bool = True
+    CONCURRENCY_INITIAL_LIMIT: int = 50
+    CONCURRENCY_MIN_LIMIT: int = 10
+    CONCURRENCY_MAX_LIMIT: int = 1000
+    CONCURRENCY_SMOOTHING: float = 0.2
+    CONCURRENCY_RTT_TOLERANCE: float = 1.5
+    CONCURRENCY_CLASS_SHARES: dict[str, float] = {"read": 1.0, "write": 0.9, "auth": 0.5}
+    CONCURRENCY_AUTH_PATHS: list[str] = ["/login", "/register"]
+    CONCURRENCY_RETRY_AFTER: int = 1
+
+    # per-client limit enforced by mw.RateLimit with one Lua call per request
+    RATE_LIMIT_STRATEGY: Literal["sliding_window", "token_bucket"] = "sliding_window"
+    RATE_LIMIT_REQUESTS: int = 100
+    RATE_LIMIT_WINDOW: int = 60
+    # "local" decides in-process with token buckets and syncs to redis every
+    # RATE_LIMIT_SYNC_INTERVAL_MS; each worker lets RATE_LIMIT_LOCAL_OVERSHOOT
+    # units per client through between syncs. The strategy is ignored in this mode.
+    RATE_LIMIT_MODE: Literal["redis", "local"] = "redis"
+    RATE_LIMIT_SYNC_INTERVAL_MS: int = 250
+    RATE_LIMIT_LOCAL_OVERSHOOT: int = 10
+    # first match wins; anything unmatched costs 1 unit of the per-ip default budget
+    RATE_LIMIT_POLICIES: list[RateLimitPolicy] = [
+        RateLimitPolicy(name="auth", path="/login", methods=["POST"], cost=25, limit=250),
+        RateLimitPolicy(name="auth", path="/register", methods=["POST"], cost=25, limit=250),
+        RateLimitPolicy(name="import", path="/notes/import", methods=["POST"], cost=50, scope="sub", limit=500),
+        RateLimitPolicy(name="export", path="/notes/export", methods=["GET"], cost=20, scope="sub", limit=500),
+        RateLimitPolicy(name="search", path="/notes/notes", methods=["GET"], query=["search"], cost=5, scope="sub", limit=500),
+        RateLimitPolicy(name="notes", path="/notes/*", scope="sub", limit=1000),
+    ]
+
+    # notes list cache
+    NOTES_CACHE_TTL: int = 60
+    CACHE_LOCK_TTL_MS: int = 5000
+    CACHE_LOCK_WAIT_MS: int = 2000
+    CACHE_LOCK_POLL_MS: int = 50
+    CACHE_EARLY_REFRESH_BETA: float = 1.0
+    NOTES_LOCAL_CACHE_ENTRIES: int = 1024
+    NOTES_LOCAL_CACHE_BYTES: int = 32 * 1024 * 1024
+    NOTES_LOCAL_CACHE_TTL: int = 10
+    NOTES_CACHE_COMPRESS: bool = False
+    NOTES_CACHE_COMPRESS_MIN_BYTES: int = 1024
+
+    NOTES_EXPORT_BATCH_SIZE: int = 1000
+    NOTES_IMPORT_BATCH_SIZE: int = 500
+    NOTES_IMPORT_MAX_ERRORS: int = 1000
+    NOTES_IMPORT_DIR: str = "./imports"
+    NOTES_BATCH_MAX_OPS: int = 500
+    NOTES_BATCH_MAX_IDS: int = 100
+    NOTE_CACHE_TTL: int = 300
+    NOTE_NEGATIVE_CACHE_TTL: int = 30
+
+    # authenticated principal cache (get_user)
+    AUTH_CACHE_SIZE: int = 10000
+    AUTH_CACHE_TTL: int = 60
+    AUTH_CACHE_REDIS: bool = False
+
+    # bcrypt process pool for /register and /login
+    PASSWORD_HASH_WORKERS: int = 2
+    PASSWORD_HASH_MAX_QUEUE: int = 64
+
     model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8")
 
 @lru_cache
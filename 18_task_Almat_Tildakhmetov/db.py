@@ -0,0 +1,109 @@
+import asyncio
+import itertools
+import time
+
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlmodel import create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from config import settings
+
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgres": "postgresql+asyncpg",
+    "postgresql": "postgresql+asyncpg",
+}
+
+
+def async_url(url: str):
+    url = make_url(url)
+    backend = url.drivername.split("+")[0]
+    return url.set(drivername=ASYNC_DRIVERS.get(backend, url.drivername))
+
+
+def engine_options(url: str) -> dict:
+    options = {"pool_pre_ping": settings.DB_POOL_PRE_PING}
+    if make_url(url).get_backend_name() != "sqlite":
+        options.update(
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+        )
+    return options
+
+
+# sync engine is kept for create_all, alembic and celery tasks
+engine = create_engine(settings.DATABASE_URL, echo=settings.DB_ECHO)
+
+async_engine = create_async_engine(
+    async_url(settings.DATABASE_URL),
+    echo=settings.DB_ECHO,
+    **engine_options(settings.DATABASE_URL),
+)
+async_session_maker = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
+
+async def get_async_session():
+    async with async_session_maker() as session:
+        yield session
+
+
+class ReplicaPool:
+    # read replicas with background health checks; reads fail over to the
+    # next healthy replica and finally to the primary
+    def __init__(self, urls: list[str]):
+        self.replicas = []
+        for url in urls:
+            replica_engine = create_async_engine(async_url(url), echo=settings.DB_ECHO, **engine_options(url))
+            self.replicas.append({
+                "engine": replica_engine,
+                "session_maker": async_sessionmaker(replica_engine, class_=AsyncSession, expire_on_commit=False),
+                "healthy": True,
+            })
+        self._order = itertools.cycle(range(len(self.replicas)))
+
+    def session_maker(self):
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self._order)]
+            if replica["healthy"]:
+                return replica["session_maker"]
+        return async_session_maker
+
+    async def check(self):
+        for replica in self.replicas:
+            try:
+                async with asyncio.timeout(settings.DB_REPLICA_HEALTH_TIMEOUT):
+                    async with replica["engine"].connect() as conn:
+                        await conn.execute(text("SELECT 1"))
+                replica["healthy"] = True
+            except Exception as e:
+                if replica["healthy"]:
+                    print(f"Replica {replica['engine'].url.render_as_string()} marked unhealthy: {e}")
+                replica["healthy"] = False
+
+    async def run_health_checks(self):
+        while True:
+            await self.check()
+            await asyncio.sleep(settings.DB_REPLICA_HEALTH_INTERVAL)
+
+
+replicas = ReplicaPool(settings.DATABASE_REPLICA_URLS)
+
+# users who wrote recently read from the primary until replicas have caught up
+_primary_until: dict[int, float] = {}
+
+
+def mark_written(user_id: int):
+    _primary_until[user_id] = time.monotonic() + settings.DB_READ_YOUR_WRITES_SECONDS
+    if len(_primary_until) > 10000:
+        now = time.monotonic()
+        for key in [key for key, until in _primary_until.items() if until <= now]:
+            del _primary_until[key]
+
+
+def read_session_maker(user_id: int | None = None):
+    if user_id is not None and _primary_until.get(user_id, 0) > time.monotonic():
+        return async_session_maker
+    return replicas.session_maker()
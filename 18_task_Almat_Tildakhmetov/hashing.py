@@ -0,0 +1,90 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+from prometheus_client import Gauge, Histogram
+
+from config import settings
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+HASH_QUEUE_WAIT = Histogram("password_hash_queue_wait_seconds", "Time password jobs wait for a pool worker", ["op"])
+HASH_EXECUTION = Histogram("password_hash_execution_seconds", "Time spent running bcrypt in the pool", ["op"])
+HASH_PENDING = Gauge("password_hash_pending", "Password jobs queued or running in the pool")
+
+_executor: ProcessPoolExecutor | None = None
+_pending = 0
+
+
+def _hash(password: str):
+    started = time.time()
+    return pwd_context.hash(password), started, time.time()
+
+
+def _verify(plain_password: str, hashed_password: str):
+    started = time.time()
+    return pwd_context.verify(plain_password, hashed_password), started, time.time()
+
+
+def _warm_up():
+    # unpickling this imports the module, and passlib with it, in the worker
+    pass
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # workers come from a forkserver: forking the running server would copy the
+        # locks its threads (anyio pool, aiosqlite, redis) may be holding
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.PASSWORD_HASH_WORKERS,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+    return _executor
+
+
+def start_executor():
+    # started with the app, so the first logins don't wait for the workers to come up
+    executor = get_executor()
+    for _ in range(settings.PASSWORD_HASH_WORKERS):
+        executor.submit(_warm_up)
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def _run(op: str, fn, *args):
+    global _pending
+    if _pending >= settings.PASSWORD_HASH_MAX_QUEUE:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server busy, try again later",
+            headers={"Retry-After": "1"},
+        )
+    _pending += 1
+    HASH_PENDING.inc()
+    submitted = time.time()
+    try:
+        loop = asyncio.get_running_loop()
+        result, started, finished = await loop.run_in_executor(get_executor(), fn, *args)
+    finally:
+        _pending -= 1
+        HASH_PENDING.dec()
+    HASH_QUEUE_WAIT.labels(op=op).observe(max(started - submitted, 0))
+    HASH_EXECUTION.labels(op=op).observe(finished - started)
+    return result
+
+
+async def hash_password(password: str) -> str:
+    return await _run("hash", _hash, password)
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await _run("verify", _verify, plain_password, hashed_password)
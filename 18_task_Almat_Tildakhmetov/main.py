@@ -1,24 +1,33 @@
 from fastapi import FastAPI, Depends, HTTPException, status, BackgroundTasks, WebSocket, WebSocketDisconnect
 from fastapi.security import OAuth2PasswordBearer
-from sqlmodel import SQLModel, Session, create_engine, select, Field, Relationship
+from sqlmodel import SQLModel, select, Field
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional, List, Literal
 import os
-from passlib.context import CryptContext
+import time
 from jose import JWTError, jwt
-from datetime import datetime, timedelta
-from note_url import router as note_router
+from datetime import datetime, timedelta, UTC
 from celery_app import send_email_task
 from config import settings
 import logging
 from pythonjsonlogger import jsonlogger
 from prometheus_fastapi_instrumentator import Instrumentator
-from fastapi import FastAPI, Request
-from mw import RateLimit
+from fastapi import FastAPI
+from mw import RateLimit, RequestLogging, ConcurrencyLimit
+from hashing import hash_password, verify_password, start_executor, shutdown_executor
+from auth_cache import listen_for_user_invalidations, principal_cache, token_fingerprint
+from sqlalchemy import Index, event, inspect
+from sqlalchemy.orm import Session, object_session
+from db import engine, get_async_session, read_session_maker, replicas
+from shards import note_shards, reserve_id_range
+from search import ensure_search_index
+from note_changes import utcnow
+from redis_client import listen_for_invalidations
+import asyncio
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 
 app = FastAPI()
-app.add_middleware(RateLimit)
 # JSON logging config
 logger = logging.getLogger()
 logHandler = logging.StreamHandler()
@@ -27,12 +36,11 @@ logHandler.setFormatter(formatter)
 logger.handlers = [logHandler]
 logger.setLevel(logging.INFO)
 
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    logger.info({"event": "request_start", "method": request.method, "url": str(request.url)})
-    response = await call_next(request)
-    logger.info({"event": "request_end", "status_code": response.status_code})
-    return response
+app.add_middleware(RateLimit)
+# outside the rate limiter so shed requests never reach redis
+if settings.CONCURRENCY_LIMIT_ENABLED:
+    app.add_middleware(ConcurrencyLimit)
+app.add_middleware(RequestLogging, logger=logger)
 
 @app.get("/health")
 def health():
@@ -41,24 +49,51 @@ def health():
 
 Instrumentator().instrument(app).expose(app)
 
-engine = create_engine(settings.DATABASE_URL, echo=True)
-SQLModel.metadata.create_all(engine)
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# in a startup hook so it runs after the table models below are declared
+@app.on_event("startup")
+def create_tables():
+    SQLModel.metadata.create_all(engine)
+    ensure_search_index(engine)
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
-app.include_router(note_router, prefix="/notes", tags=["notes"])
-
-def get_session():
-    with Session(engine) as session:
-        yield session
-
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
-
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+@app.on_event("startup")
+def start_password_pool():
+    start_executor()
+
+@app.on_event("shutdown")
+def stop_password_pool():
+    shutdown_executor()
+
+@app.on_event("startup")
+async def start_cache_invalidation_listener():
+    app.state.cache_listener = asyncio.create_task(listen_for_invalidations())
+    app.state.auth_listener = asyncio.create_task(listen_for_user_invalidations())
+
+@app.on_event("shutdown")
+async def stop_cache_invalidation_listener():
+    app.state.cache_listener.cancel()
+    app.state.auth_listener.cancel()
+
+@app.on_event("startup")
+def prepare_note_shards():
+    if not note_shards.sharded:
+        return
+    for index, shard in enumerate(note_shards.shards):
+        SQLModel.metadata.create_all(shard["engine"], tables=[Note.__table__, NoteSequence.__table__, NoteTombstone.__table__])
+        ensure_search_index(shard["engine"])
+        reserve_id_range(shard["engine"], index)
+
+@app.on_event("startup")
+async def start_replica_health_checks():
+    if replicas.replicas:
+        app.state.replica_health = asyncio.create_task(replicas.run_health_checks())
+
+@app.on_event("shutdown")
+async def stop_replica_health_checks():
+    if replicas.replicas:
+        app.state.replica_health.cancel()
 
 def create_token(data: dict) -> str:
     to_encode = data.copy()
@@ -68,7 +103,14 @@ def create_token(data: dict) -> str:
     return encode_jwt
 
 
-def get_user(token: str = Depends(oauth2_scheme), session: Session = Depends(get_session)):
+# a cache miss reads the primary: a lagging replica could cache a demoted user's old role
+async def get_user(token: str = Depends(oauth2_scheme), session: AsyncSession = Depends(get_async_session)):
+    fingerprint = token_fingerprint(token)
+    principal = await principal_cache.get(fingerprint)
+    if principal is not None:
+        return User(**principal)
+    read_at = time.time()
+
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
         username: str = payload.get("sub")
@@ -85,13 +127,14 @@ def get_user(token: str = Depends(oauth2_scheme), session: Session = Depends(get
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    user = session.exec(select(User).where(User.username == username)).first()
+    user = (await session.exec(select(User).where(User.username == username))).first()
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not found",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    await principal_cache.set(fingerprint, {"id": user.id, "username": user.username, "role": user.role}, payload["exp"], read_at)
     return user
 
 def role(required_role: str):
@@ -110,6 +153,23 @@ class User(SQLModel, table=True):
     password: str
     role: str = Field(default="user")
 
+
+@event.listens_for(User, "after_update")
+def collect_principal_changes(mapper, connection, target):
+    state = inspect(target)
+    if state.attrs.role.history.has_changes() or state.attrs.password.history.has_changes():
+        object_session(target).info.setdefault("changed_users", set()).add(target.id)
+
+# the flush isn't visible to other requests until commit, so they could cache the old row again
+@event.listens_for(Session, "after_commit")
+def invalidate_principals(session):
+    for user_id in session.info.pop("changed_users", ()):
+        principal_cache.invalidate_user_nowait(user_id)
+
+@event.listens_for(Session, "after_rollback")
+def forget_principal_changes(session):
+    session.info.pop("changed_users", None)
+
 class UserCreate(BaseModel):
     username: str
     password: str
@@ -131,11 +191,37 @@ class Token(BaseModel):
     token_type: str = "bearer"
 
 class Note(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_note_owner_id_id", "owner_id", "id"),
+        Index("ix_note_owner_id_seq", "owner_id", "seq"),
+        # keeps the id counter in sqlite_sequence so a shard's id range can be set
+        {"sqlite_autoincrement": True},
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     title: str
     content: str
-    owner_id: int = Field(foreign_key="user.id")
-    owner: User = Relationship(back_populates="notes")
+    # no foreign key: notes may live on a different database than users
+    owner_id: int
+    updated_at: datetime = Field(default_factory=utcnow)
+    # per-owner change number from NoteSequence, bumped on every write
+    seq: int = Field(default=0)
+
+class NoteSequence(SQLModel, table=True):
+    __tablename__ = "note_sequence"
+
+    owner_id: int = Field(primary_key=True)
+    value: int = Field(default=0)
+
+class NoteTombstone(SQLModel, table=True):
+    __tablename__ = "note_tombstone"
+    __table_args__ = (Index("ix_note_tombstone_owner_id_seq", "owner_id", "seq"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    owner_id: int
+    note_id: int
+    seq: int
+    deleted_at: datetime = Field(default_factory=utcnow)
 
 class NoteCreate(BaseModel):
     title: str
@@ -147,38 +233,84 @@ class NoteResponse(BaseModel):
     content: str
     owner_id: int
 
+class NoteSummary(BaseModel):
+    id: int
+    title: str
+    owner_id: int
+
+class NoteChange(NoteResponse):
+    updated_at: datetime
+    seq: int
+
+class NoteChanges(BaseModel):
+    changes: List[NoteChange]
+    deleted: List[int]
+    since: int
+    has_more: bool
+
 class NoteUpdate(BaseModel):
     title: Optional[str] = None
     content: Optional[str] = None
 
+class NoteBatchOp(BaseModel):
+    op: Literal["create", "update", "delete"]
+    id: Optional[int] = None
+    title: Optional[str] = None
+    content: Optional[str] = None
+
+class NoteBatchResult(BaseModel):
+    op: str
+    id: Optional[int] = None
+    status: int
+    detail: Optional[str] = None
+    note: Optional[NoteResponse] = None
+
+
+async def get_read_session(current_user: User = Depends(get_user)):
+    async with read_session_maker(current_user.id)() as session:
+        yield session
+
+# sessions on the shard that holds the current user's notes
+async def get_note_session(current_user: User = Depends(get_user)):
+    async with note_shards.session_maker(current_user.id)() as session:
+        yield session
+
+async def get_note_read_session(current_user: User = Depends(get_user)):
+    async with note_shards.read_session_maker(current_user.id)() as session:
+        yield session
+
+# note_url imports the models and dependencies above from this module
+from note_url import router as note_router
+app.include_router(note_router, prefix="/notes", tags=["notes"])
+
 
 @app.post("/register", response_model=UserResponse)
-def register(user: UserCreate, session: Session = Depends(get_session)):
-    existing_user = session.exec(
+async def register(user: UserCreate, session: AsyncSession = Depends(get_async_session)):
+    existing_user = (await session.exec(
         select(User).where(User.username == user.username)
-    ).first()
+    )).first()
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username already exists"
         )
 
-    user.password = get_password_hash(user.password)
+    user.password = await hash_password(user.password)
     db_user = User(username=user.username, password=user.password, role=user.role)
     session.add(db_user)
-    session.commit()
-    session.refresh(db_user)
+    await session.commit()
+    await session.refresh(db_user)
 
     return UserResponse(id=db_user.id, username=db_user.username)
 
 
 @app.post("/login")
-def login(user: UserLogin, session: Session = Depends(get_session)):
-    db_user = session.exec(
+async def login(user: UserLogin, session: AsyncSession = Depends(get_async_session)):
+    db_user = (await session.exec(
         select(User).where(User.username == user.username)
-    ).first()
+    )).first()
 
-    if not db_user or db_user.password != user.password:
+    if not db_user or not await verify_password(user.password, db_user.password):
         raise HTTPException(
             status.HTTP_401_UNAUTHORIZED,
             detail="Invalid credentials"
@@ -191,8 +323,8 @@ def me_api(user: User = Depends(get_user)):
     return UserResponse(id=user.id, username=user.username)
 
 @app.get("/admin/users", response_model=list[UserResponse], dependencies=[Depends(role("admin"))])
-def get_users(session: Session = Depends(get_session())):
-    users = session.exec(select(User).all())
+async def get_users(session: AsyncSession = Depends(get_read_session)):
+    users = (await session.exec(select(User))).all()
     return [UserResponse(id=user.id, username=user.username, role=user.role) for user in users]
 
 @app.post("/send-email/")
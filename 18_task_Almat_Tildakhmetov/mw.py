@@ -1,45 +1,417 @@
-from fastapi import Request, HTTPException
 from fastapi.responses import JSONResponse
+from starlette.datastructures import URL, Headers, MutableHeaders, QueryParams
 from redis.asyncio import Redis, from_url
-from config import settings
+from redis.exceptions import NoScriptError
+from prometheus_client import Counter, Gauge
+from config import settings, RateLimitPolicy
+from jose import JWTError, jwt
+import asyncio
+import fnmatch
+import math
+import re
+import logging
 import time
-from starlette.middleware.base import BaseHTTPMiddleware
 
-class RateLimit(BaseHTTPMiddleware):
-    def __init__(self):
-        super().__init__(app)
-        self.redis = None
+# Both scripts read the clock with TIME so every worker agrees on it, and run
+# atomically on the server: check and charge are one round trip with no race.
+# KEYS[1] is the client's key; ARGV is limit, window in ms, cost.
+# They return {allowed, remaining, retry after ms}.
+SLIDING_WINDOW_SCRIPT = """
+local limit, window, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = clock[1] * 1000 + math.floor(clock[2] / 1000)
+local current = math.floor(now / window)
+local state = redis.call('HMGET', KEYS[1], 'window', 'current', 'previous')
+local stored, used_now, used_before = tonumber(state[1]), tonumber(state[2]) or 0, tonumber(state[3]) or 0
+if stored ~= current then
+    used_before = (stored == current - 1) and used_now or 0
+    used_now = 0
+end
+-- the previous fixed window counts for the share of it still inside the sliding window
+local overlap = 1 - (now % window) / window
+local used = used_before * overlap + used_now
+local allowed, retry = 0, 0
+if used + cost <= limit then
+    allowed, used_now, used = 1, used_now + cost, used + cost
+elseif used_before > 0 and used_now + cost <= limit then
+    retry = math.ceil((used + cost - limit) * window / used_before)
+else
+    retry = window - now % window
+end
+redis.call('HSET', KEYS[1], 'window', current, 'current', used_now, 'previous', used_before)
+redis.call('PEXPIRE', KEYS[1], window * 2)
+return {allowed, math.max(0, math.floor(limit - used)), retry}
+"""
+
+TOKEN_BUCKET_SCRIPT = """
+local capacity, window, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = clock[1] * 1000 + math.floor(clock[2] / 1000)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens, updated = tonumber(state[1]) or capacity, tonumber(state[2]) or now
+-- refills the whole bucket over one window
+tokens = math.min(capacity, tokens + (now - updated) * capacity / window)
+local allowed, retry = 0, 0
+if tokens >= cost then
+    allowed, tokens = 1, tokens - cost
+else
+    retry = math.ceil((cost - tokens) * window / capacity)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('PEXPIRE', KEYS[1], window)
+return {allowed, math.max(0, math.floor(tokens)), retry}
+"""
+
+# Folds a batch of locally counted hits into the same buckets TOKEN_BUCKET_SCRIPT
+# uses. KEYS are the buckets, ARGV is capacity, window in ms, then one count per
+# key. Buckets may go into debt, which the next sync hands back to every worker.
+# Returns the tokens left in each bucket.
+RECONCILE_SCRIPT = """
+local capacity, window = tonumber(ARGV[1]), tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = clock[1] * 1000 + math.floor(clock[2] / 1000)
+local balances = {}
+for i, key in ipairs(KEYS) do
+    local state = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens, updated = tonumber(state[1]) or capacity, tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + (now - updated) * capacity / window)
+    tokens = math.max(-capacity, tokens - tonumber(ARGV[i + 2]))
+    redis.call('HSET', key, 'tokens', tokens, 'updated', now)
+    redis.call('PEXPIRE', key, window * 2)
+    balances[i] = tostring(tokens)
+end
+return balances
+"""
+
+RATE_LIMIT_SCRIPTS = {
+    "sliding_window": SLIDING_WINDOW_SCRIPT,
+    "token_bucket": TOKEN_BUCKET_SCRIPT,
+}
+
+
+class LuaScript:
+    # loaded once with SCRIPT LOAD; every call is a single EVALSHA
+    def __init__(self, redis: Redis, source: str):
+        self.redis = redis
+        self.source = source
+        self.sha = None
+
+    async def __call__(self, keys: list[str], args: list):
+        if self.sha is None:
+            self.sha = await self.redis.script_load(self.source)
+        try:
+            return await self.redis.evalsha(self.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            # the script cache is empty after a redis restart or failover
+            self.sha = await self.redis.script_load(self.source)
+            return await self.redis.evalsha(self.sha, len(keys), *keys, *args)
+
+
+class RedisRateLimiter:
+    def __init__(self, redis: Redis, strategy: str, limit: int, window_ms: int):
+        self.strategy = strategy
+        self.script = LuaScript(redis, RATE_LIMIT_SCRIPTS[strategy])
+        self.limit = limit
+        self.window_ms = window_ms
+
+    async def hit(self, key: str, cost: int = 1) -> tuple[bool, int, int]:
+        allowed, remaining, retry_ms = await self.script([f"rate_limit:{self.strategy}:{key}"], [self.limit, self.window_ms, cost])
+        return bool(allowed), int(remaining), int(retry_ms)
+
 
-    async def dispatch(self, request: Request, call_next):
+class LocalRateLimiter:
+    # Token buckets kept in this worker and decided without a network call. A
+    # background task pushes the hits counted since the last sync to redis in one
+    # EVALSHA every sync_interval_ms and takes back the fleet-wide balance.
+    # Between syncs a worker lets at most `overshoot` units per key (or one charge,
+    # if that is larger) through unconfirmed, so the fleet can exceed the limit by
+    # about workers * max(overshoot, cost). While redis can't be reached each
+    # worker falls back to its own buckets alone, like the redis mode fails open.
+    def __init__(self, redis: Redis, limit: int, window_ms: int, sync_interval_ms: int, overshoot: int):
+        self.reconcile = LuaScript(redis, RECONCILE_SCRIPT)
+        self.limit = limit
+        self.window_ms = window_ms
+        self.rate = limit / window_ms
+        self.sync_interval = sync_interval_ms / 1000
+        self.overshoot = overshoot
+        # key -> [tokens, updated at (monotonic ms), units not yet pushed to redis]
+        self.buckets: dict[str, list[float]] = {}
+        self.task = None
+        # set by a failed sync, cleared by the next one that gets through
+        self.offline = False
+
+    async def hit(self, key: str, cost: int = 1) -> tuple[bool, int, int]:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run_sync())
+        now = time.monotonic() * 1000
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.limit, now, 0]
+        bucket[0] = min(self.limit, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < cost:
+            return False, 0, math.ceil((cost - bucket[0]) / self.rate)
+        if bucket[2] and bucket[2] + cost > self.overshoot and not self.offline:
+            # can't spend more until the fleet has seen this worker's share; a single
+            # charge is always let through, or costs above the overshoot could never pass
+            return False, math.floor(bucket[0]), math.ceil(self.sync_interval * 1000)
+        bucket[0] -= cost
+        bucket[2] += cost
+        return True, math.floor(bucket[0]), 0
+
+    async def sync(self):
+        now = time.monotonic() * 1000
+        # idle buckets have refilled and carry nothing to push, so they are dropped
+        for key in [key for key, bucket in self.buckets.items() if not bucket[2] and now - bucket[1] > self.window_ms]:
+            del self.buckets[key]
+        if not self.buckets:
+            return
+        keys = list(self.buckets)
+        counts = [self.buckets[key][2] for key in keys]
+        for key in keys:
+            self.buckets[key][2] = 0
         try:
-            redis = await self.get_redis()
-            client_ip = request.client.host
-            current_time = int(time.time())
-            ket = f"rate_limit:{client_ip}"
+            balances = await self.reconcile([f"rate_limit:token_bucket:{key}" for key in keys], [self.limit, self.window_ms, *counts])
+        except Exception:
+            # the counts are dropped: kept, they would hold every key at the
+            # overshoot until redis is back
+            self.offline = True
+            raise
+        self.offline = False
+        now = time.monotonic() * 1000
+        for key, balance in zip(keys, balances):
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                # hits taken while the call was in flight are still unpushed
+                bucket[0] = float(balance) - bucket[2]
+                bucket[1] = now
+
+    async def run_sync(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                print(f"Redis error in rate limiter sync: {e}")
+
+
+DEFAULT_POLICY = RateLimitPolicy(name="default", path="*")
+
 
-            data = await redis.hgetall(key)
-            if not data:
-                await redis.hset(key, mapping={"count": 1, "timestamp": current_time})
-                await redis.expire(key, settings.RATE_LIMIT_WINDOW)
-                return await call_next(request)
+def compile_policies(policies: list[RateLimitPolicy]) -> list[tuple]:
+    return [
+        (re.compile(fnmatch.translate(policy.path)), {method.upper() for method in policy.methods}, policy)
+        for policy in policies
+    ]
 
-            count = int(data.get("count", 0))
-            timestamp = int(data.get("timestamp", 0))
 
-            if current_time - timestamp > settings.RATE_LIMIT_WINDOW:
-                await redis.hset(key, mapping={"count": 1, "timestamp": current_time})
-                return await call_next(request)
+def match_policy(compiled: list[tuple], method: str, path: str, query: set[str]) -> RateLimitPolicy:
+    for pattern, methods, policy in compiled:
+        if ("*" in methods or method in methods) and pattern.match(path) and query.issuperset(policy.query):
+            return policy
+    return DEFAULT_POLICY
 
-            if count >= settings.RATE_LIMIT_REQUESTS:
-                return JSONResponse(
-                    status_code=429,
-                    content={"detail": "Rate limit exceeded. Try again later."}
-                )
 
-            await redis.hincrby(key, "count", 1)
+def token_subject(authorization: str | None) -> str | None:
+    # verified, so a client can't dodge its budget by making up subjects
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM]).get("sub")
+    except JWTError:
+        return None
 
-            return await call_next(request)
 
+# These middlewares are plain ASGI: no BaseHTTPMiddleware task, memory stream
+# or response rewrapping per request, and streaming responses pass straight through.
+class RateLimit:
+    def __init__(self, app, skip_paths: list[str] | None = None):
+        self.app = app
+        self.skip_paths = frozenset(settings.MIDDLEWARE_SKIP_PATHS if skip_paths is None else skip_paths)
+        self.policies = compile_policies(settings.RATE_LIMIT_POLICIES)
+        self.redis = None
+        # one limiter per budget; policies sharing a name share the budget
+        self.limiters = {}
+
+    def get_limiter(self, policy: RateLimitPolicy):
+        limiter = self.limiters.get(policy.name)
+        if limiter is None:
+            if self.redis is None:
+                self.redis = from_url(settings.REDIS_URL)
+            limit = policy.limit or settings.RATE_LIMIT_REQUESTS
+            window_ms = (policy.window or settings.RATE_LIMIT_WINDOW) * 1000
+            if settings.RATE_LIMIT_MODE == "local":
+                limiter = LocalRateLimiter(self.redis, limit, window_ms, settings.RATE_LIMIT_SYNC_INTERVAL_MS, settings.RATE_LIMIT_LOCAL_OVERSHOOT)
+            else:
+                limiter = RedisRateLimiter(self.redis, settings.RATE_LIMIT_STRATEGY, limit, window_ms)
+            self.limiters[policy.name] = limiter
+        return limiter
+
+    def client_key(self, scope, policy: RateLimitPolicy) -> str:
+        if policy.scope == "global":
+            return f"{policy.name}:global"
+        if policy.scope == "sub":
+            subject = token_subject(Headers(scope=scope).get("authorization"))
+            if subject is not None:
+                return f"{policy.name}:sub:{subject}"
+        # anonymous requests to per-user routes are counted per ip
+        client = scope.get("client")
+        return f"{policy.name}:ip:{client[0] if client else 'unknown'}"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+
+        query = set(QueryParams(scope["query_string"])) if scope["query_string"] else set()
+        policy = match_policy(self.policies, scope["method"], scope["path"], query)
+        try:
+            limiter = self.get_limiter(policy)
+            allowed, remaining, retry_ms = await limiter.hit(self.client_key(scope, policy), policy.cost)
         except Exception as e:
             print(f"Redis error in rate limiter: {e}")
-            return await call_next(request)
\ No newline at end of file
+            await self.app(scope, receive, send)
+            return
+
+        headers = {"X-RateLimit-Limit": str(limiter.limit), "X-RateLimit-Remaining": str(remaining), "X-RateLimit-Policy": policy.name}
+        if not allowed:
+            headers["Retry-After"] = str(max(1, -(-retry_ms // 1000)))
+            response = JSONResponse(
+                status_code=429,
+                content={"detail": "Rate limit exceeded. Try again later."},
+                headers=headers,
+            )
+            await response(scope, receive, send)
+            return
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).update(headers)
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
+class RequestLogging:
+    def __init__(self, app, logger: logging.Logger | None = None, skip_paths: list[str] | None = None):
+        self.app = app
+        self.logger = logger or logging.getLogger()
+        self.skip_paths = frozenset(settings.MIDDLEWARE_SKIP_PATHS if skip_paths is None else skip_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+
+        self.logger.info({"event": "request_start", "method": scope["method"], "url": str(URL(scope=scope))})
+        status_code = None
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        await self.app(scope, receive, send_with_status)
+        self.logger.info({"event": "request_end", "status_code": status_code})
+
+
+CONCURRENCY_LIMIT = Gauge("concurrency_limit", "Current adaptive limit on in-flight requests")
+CONCURRENCY_INFLIGHT = Gauge("concurrency_inflight", "Requests currently being served", ["route_class"])
+CONCURRENCY_SHED = Counter("concurrency_shed_total", "Requests rejected with 503 by the concurrency limit", ["route_class"])
+
+
+class GradientLimit:
+    # Gradient-style adaptive limit: compares a fast-moving average of request
+    # latency with a slow baseline. While latency holds at the baseline the limit
+    # grows by about sqrt(limit) per sample; once queueing pushes latency up the
+    # ratio drops below 1 and the limit shrinks in proportion, down to half per sample.
+    def __init__(self, initial: int, min_limit: int, max_limit: int, smoothing: float, tolerance: float):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.short_rtt = None
+        self.long_rtt = None
+        CONCURRENCY_LIMIT.set(self.limit)
+
+    def sample(self, rtt: float, inflight: int):
+        if self.short_rtt is None:
+            self.short_rtt = self.long_rtt = rtt
+        self.short_rtt += (rtt - self.short_rtt) * 0.1
+        self.long_rtt += (rtt - self.long_rtt) / 600
+        if self.long_rtt > self.short_rtt * 2:
+            # load went away; let the baseline come back down quickly
+            self.long_rtt *= 0.95
+
+        gradient = max(0.5, min(1.0, self.tolerance * self.long_rtt / self.short_rtt))
+        new_limit = self.limit * gradient + self.limit ** 0.5
+        if new_limit > self.limit and inflight < self.limit / 2:
+            # not using the limit we have, so there is no evidence it can go higher
+            return
+        self.limit = self.limit * (1 - self.smoothing) + new_limit * self.smoothing
+        self.limit = max(self.min_limit, min(self.max_limit, self.limit))
+        CONCURRENCY_LIMIT.set(self.limit)
+
+
+class ConcurrencyLimit:
+    # Sheds requests with a fast 503 once the adaptive limit is reached, so the
+    # ones already admitted keep their latency instead of everyone queueing.
+    def __init__(self, app, skip_paths: list[str] | None = None):
+        self.app = app
+        self.skip_paths = frozenset(settings.MIDDLEWARE_SKIP_PATHS if skip_paths is None else skip_paths)
+        self.auth_paths = frozenset(settings.CONCURRENCY_AUTH_PATHS)
+        self.shares = settings.CONCURRENCY_CLASS_SHARES
+        self.limiter = GradientLimit(
+            settings.CONCURRENCY_INITIAL_LIMIT,
+            settings.CONCURRENCY_MIN_LIMIT,
+            settings.CONCURRENCY_MAX_LIMIT,
+            settings.CONCURRENCY_SMOOTHING,
+            settings.CONCURRENCY_RTT_TOLERANCE,
+        )
+        self.inflight = 0
+
+    def route_class(self, scope) -> str:
+        if scope["path"] in self.auth_paths:
+            return "auth"
+        return "read" if scope["method"] in ("GET", "HEAD", "OPTIONS") else "write"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+
+        route_class = self.route_class(scope)
+        if self.inflight >= self.limiter.limit * self.shares.get(route_class, 1.0):
+            CONCURRENCY_SHED.labels(route_class).inc()
+            response = JSONResponse(
+                status_code=503,
+                content={"detail": "Server is overloaded. Try again later."},
+                headers={"Retry-After": str(settings.CONCURRENCY_RETRY_AFTER)},
+            )
+            await response(scope, receive, send)
+            return
+
+        self.inflight += 1
+        CONCURRENCY_INFLIGHT.labels(route_class).inc()
+        started = time.monotonic()
+        latency = None
+
+        async def send_with_latency(message):
+            nonlocal latency
+            if message["type"] == "http.response.start":
+                # time to the first byte; a streamed body (exports) can run for minutes
+                # and says nothing about how loaded the server is
+                latency = time.monotonic() - started
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_latency)
+            # a request that raised is often fast and would read as spare capacity, so it isn't sampled
+            if latency is not None:
+                self.limiter.sample(latency, self.inflight)
+        finally:
+            self.inflight -= 1
+            CONCURRENCY_INFLIGHT.labels(route_class).dec()
@@ -0,0 +1,44 @@
+from datetime import UTC, datetime
+
+from sqlalchemy import Integer, column, select, table
+from sqlalchemy.dialects import postgresql, sqlite
+
+# core table so the celery worker can reserve sequence numbers without importing main
+note_sequence = table("note_sequence", column("owner_id", Integer), column("value", Integer))
+
+UPSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def utcnow() -> datetime:
+    return datetime.now(UTC)
+
+
+def _upsert(dialect, owner_id: int, count: int):
+    insert = UPSERTS[dialect.name](note_sequence).values(owner_id=owner_id, value=count)
+    return insert.on_conflict_do_update(
+        index_elements=[note_sequence.c.owner_id],
+        set_={"value": note_sequence.c.value + insert.excluded.value},
+    )
+
+
+def _current(owner_id: int):
+    return select(note_sequence.c.value).where(note_sequence.c.owner_id == owner_id)
+
+
+# Both return the highest of `count` freshly reserved change numbers for the owner.
+# The upsert locks the owner's counter row until commit, so numbers are handed out
+# in commit order and a client syncing with since=<seq> never skips a change.
+async def reserve_seq(session, owner_id: int, count: int = 1) -> int:
+    dialect = session.bind.dialect
+    if dialect.insert_returning:
+        return (await session.execute(_upsert(dialect, owner_id, count).returning(note_sequence.c.value))).scalar_one()
+    await session.execute(_upsert(dialect, owner_id, count))
+    return (await session.execute(_current(owner_id))).scalar_one()
+
+
+def reserve_seq_sync(session, owner_id: int, count: int = 1) -> int:
+    dialect = session.bind.dialect
+    if dialect.insert_returning:
+        return session.execute(_upsert(dialect, owner_id, count).returning(note_sequence.c.value)).scalar_one()
+    session.execute(_upsert(dialect, owner_id, count))
+    return session.execute(_current(owner_id)).scalar_one()
@@ -0,0 +1,85 @@
+import csv
+import io
+import json
+
+from sqlalchemy import column, insert, table
+
+from note_changes import reserve_seq_sync, utcnow
+
+# lightweight core table so the celery worker can insert without importing main
+note_table = table("note", column("id"), column("title"), column("content"), column("owner_id"), column("seq"), column("updated_at"))
+
+
+def parse_row(data) -> dict | str:
+    if not isinstance(data, dict):
+        return "expected an object with title and content"
+    title, content = data.get("title"), data.get("content")
+    if not isinstance(title, str) or not title:
+        return "title is required"
+    if not isinstance(content, str):
+        return "content is required"
+    return {"title": title, "content": content}
+
+
+def iter_rows(stream, fmt: str):
+    # stream is a binary file; rows are parsed one line at a time
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    try:
+        if fmt == "csv":
+            for line_no, row in enumerate(csv.DictReader(text), start=2):
+                yield line_no, parse_row(row)
+        else:
+            for line_no, line in enumerate(text, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    yield line_no, parse_row(json.loads(line))
+                except ValueError as e:
+                    yield line_no, f"invalid JSON: {e}"
+    finally:
+        text.detach()
+
+
+def iter_batches(stream, fmt: str, batch_size: int):
+    rows, errors = [], []
+    for line_no, row in iter_rows(stream, fmt):
+        if isinstance(row, str):
+            errors.append({"line": line_no, "error": row})
+            continue
+        rows.append(row)
+        if len(rows) >= batch_size:
+            yield rows, errors
+            rows, errors = [], []
+    if rows or errors:
+        yield rows, errors
+
+
+def insert_statement(rows: list[dict], owner_id: int, last_seq: int, returning: bool = False):
+    # one multi-row INSERT ... VALUES per batch, numbered up to last_seq
+    first_seq, now = last_seq - len(rows) + 1, utcnow()
+    statement = insert(note_table).values([
+        {**row, "owner_id": owner_id, "seq": first_seq + i, "updated_at": now} for i, row in enumerate(rows)
+    ])
+    # the new ids let callers drop negative per-note cache entries
+    return statement.returning(note_table.c.id) if returning else statement
+
+
+def record_errors(report: dict, batch_errors: list[dict], max_errors: int):
+    report["error_count"] += len(batch_errors)
+    report["errors"].extend(batch_errors[:max(0, max_errors - len(report["errors"]))])
+
+
+def run_import(session, stream, fmt: str, owner_id: int, batch_size: int, max_errors: int, on_inserted=None) -> dict:
+    report = {"imported": 0, "error_count": 0, "errors": []}
+    returning = on_inserted is not None and session.bind.dialect.insert_returning
+    for rows, batch_errors in iter_batches(stream, fmt, batch_size):
+        record_errors(report, batch_errors, max_errors)
+        if rows:
+            last_seq = reserve_seq_sync(session, owner_id, len(rows))
+            result = session.execute(insert_statement(rows, owner_id, last_seq, returning))
+            note_ids = result.scalars().all() if returning else []
+            session.commit()
+            report["imported"] += len(rows)
+            if note_ids:
+                on_inserted(note_ids)
+    return report
@@ -1,67 +1,409 @@
-import aioredis
-from fastapi import APIRouter, Query, Depends
-from main import get_user, User, session, select, Note, NoteResponse, NoteUpdate, HTTPException
-from .redis_client import get_redis
-from typing import List
+from fastapi import APIRouter, Query, Depends, Request, Response, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from main import get_user, get_note_session, get_note_read_session, User, select, Note, NoteResponse, NoteSummary, NoteUpdate, NoteBatchOp, NoteBatchResult, NoteChange, NoteChanges, NoteTombstone, HTTPException
+from note_changes import reserve_seq, utcnow
+from sqlalchemy import insert, update, delete
+from shards import note_shards
+from sqlmodel.ext.asyncio.session import AsyncSession
+from redis_client import get_redis, get_redis_bytes, get_notes_generation, bump_notes_generation, cached, note_cache_key
+from config import settings
+from typing import List, Literal
+from search import apply_search
+from note_import import iter_batches, insert_statement, record_errors
+from celery_app import import_notes_task
 import json
+import base64
+import gzip
+import hashlib
+import itertools
+import os
+import shutil
+import uuid
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 router = APIRouter()
 
-@router.get("/notes", response_model=List[NoteResponse])
-async def get_notes(current_user: User = Depends(get_user), skip: int = 0, limit: int = 100, search: str | None = None):
+# clients may keep a copy but must revalidate it with If-None-Match
+NOTES_CACHE_CONTROL = "private, no-cache"
+
+def dump_json(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode()
+
+# cached pages are stored as "<next cursor>\n<final response body>", the body
+# gzipped when it is large enough, so a hit is returned without decoding
+def pack_page(body: bytes, next_cursor: str | None) -> bytes:
+    if settings.NOTES_CACHE_COMPRESS and len(body) >= settings.NOTES_CACHE_COMPRESS_MIN_BYTES:
+        body = gzip.compress(body, compresslevel=1)
+    return (next_cursor or "").encode() + b"\n" + body
+
+def page_response(value: bytes, request: Request, etag: str) -> Response:
+    next_cursor, _, body = value.partition(b"\n")
+    headers = {"ETag": etag, "Cache-Control": NOTES_CACHE_CONTROL}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor.decode()
+    if body[:2] == b"\x1f\x8b":
+        headers["Vary"] = "Accept-Encoding"
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            # a different encoding is a different representation for a strong etag
+            headers["ETag"] = etag[:-1] + '-gzip"'
+        else:
+            body = gzip.decompress(body)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def make_etag(*parts) -> str:
+    return '"' + hashlib.sha1(":".join(map(str, parts)).encode()).hexdigest()[:24] + '"'
+
+def not_modified(request: Request, etag: str) -> Response | None:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return None
+    candidates = {tag.strip().removeprefix("W/").replace('-gzip"', '"') for tag in header.split(",")}
+    if etag in candidates or "*" in candidates:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": NOTES_CACHE_CONTROL})
+    return None
+
+def encode_cursor(owner_id: int, note_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{owner_id}:{note_id}".encode()).decode()
+
+def decode_cursor(cursor: str) -> tuple[int, int]:
+    try:
+        owner_id, note_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        return int(owner_id), int(note_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+# columns loaded per projection; summary never reads the content column
+NOTE_VIEWS = {
+    "full": (Note.id, Note.title, Note.content, Note.owner_id),
+    "summary": (Note.id, Note.title, Note.owner_id),
+}
+NOTE_COLUMNS = NOTE_VIEWS["full"]
+
+@router.get("/notes", response_model=List[NoteResponse] | List[NoteSummary])
+async def get_notes(request: Request, current_user: User = Depends(get_user), session: AsyncSession = Depends(get_note_read_session), skip: int = Query(default=0, ge=0), limit: int = Query(default=100, ge=1, le=1000), search: str | None = None, cursor: str | None = None, view: Literal["full", "summary"] = "full"):
+    search = search.strip() if search else None
+    redis = await get_redis_bytes()
+    page = f"c{cursor}" if cursor else skip
+    if cursor:
+        owner_id, last_id = decode_cursor(cursor)
+        if owner_id != current_user.id:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    generation = await get_notes_generation(redis, current_user.id)
+    cache_key = f"notes:{current_user.id}:g{generation}:{view}:{page}:{limit}:{search}"
+    # the generation changes on every write, so a matching etag needs no DB or cache read
+    etag = make_etag(cache_key)
+    unchanged = not_modified(request, etag)
+    if unchanged:
+        return unchanged
+
+    async def load():
+        query = select(*NOTE_VIEWS[view]).where(Note.owner_id == current_user.id)
+        if search:
+            # ranked by relevance, so search results page with skip/limit only
+            query = apply_search(query, Note, search, session.bind.dialect.name).offset(skip)
+        elif cursor:
+            # keyset over (owner_id, id): cost stays flat however deep the page is
+            query = query.where(Note.id > last_id).order_by(Note.owner_id, Note.id)
+        else:
+            query = query.order_by(Note.owner_id, Note.id).offset(skip)
+        query = query.limit(limit)
+        notes = (await session.execute(query)).all()
+        result = [note._asdict() for note in notes]
+        next_cursor = encode_cursor(current_user.id, notes[-1].id) if len(notes) == limit and not search else None
+        return pack_page(dump_json(result), next_cursor)
+
+    # hits and misses both return the cached bytes as-is, skipping response_model validation
+    value = await cached(redis, cache_key, load, settings.NOTES_CACHE_TTL, tag=current_user.id)
+    return page_response(value, request, etag)
+
+@router.get("/export")
+async def export_notes(format: Literal["ndjson", "json"] = "ndjson", current_user: User = Depends(get_user)):
+    owner_id = current_user.id
+
+    async def stream():
+        # own session: request-scoped dependencies are closed before the body is streamed
+        async with note_shards.read_session_maker(owner_id)() as session:
+            query = (
+                select(Note.id, Note.title, Note.content, Note.owner_id)
+                .where(Note.owner_id == owner_id)
+                .order_by(Note.owner_id, Note.id)
+                .execution_options(yield_per=settings.NOTES_EXPORT_BATCH_SIZE)
+            )
+            result = await session.stream(query)
+            first = True
+            if format == "json":
+                yield b"["
+            async for rows in result.partitions():
+                items = [dump_json(row._asdict()) for row in rows]
+                if format == "json":
+                    chunk = b",".join(items)
+                    yield chunk if first else b"," + chunk
+                else:
+                    yield b"\n".join(items) + b"\n"
+                first = False
+            if format == "json":
+                yield b"]"
+
+    media_type = "application/json" if format == "json" else "application/x-ndjson"
+    return StreamingResponse(stream(), media_type=media_type, headers={"Content-Disposition": f'attachment; filename="notes.{format}"'})
+
+@router.post("/import")
+async def import_notes(file: UploadFile, format: Literal["ndjson", "csv"] = "ndjson", background: bool = False, current_user: User = Depends(get_user), session: AsyncSession = Depends(get_note_session)):
+    if background:
+        # large imports: hand the spooled upload to the celery worker via the shared volume
+        os.makedirs(settings.NOTES_IMPORT_DIR, exist_ok=True)
+        path = os.path.join(settings.NOTES_IMPORT_DIR, f"{uuid.uuid4().hex}.{format}")
+
+        def save():
+            with open(path, "wb") as out:
+                shutil.copyfileobj(file.file, out)
+        await run_in_threadpool(save)
+        task = import_notes_task.delay(path, format, current_user.id)
+        return {"task_id": task.id, "status": "Import started"}
+
+    report = {"imported": 0, "error_count": 0, "errors": []}
     redis = await get_redis()
-    cache_key = f"notes:{current_user.id}:{skip}:{limit}:{search}"
-    cached = await redis.get(cache_key)
-    if cached:
-        return json.loads(cached)
-    query = select(Note).where(Note.owner_id == current_user.id)
-    if search:
-        query = query.where(Note.title.ilike(f"%{search}%") | Note.content.ilike(f"%{search}%"))
-    query = query.offset(skip).limit(limit)
-    notes = session.exec(query).all()
-    result = [NoteResponse(id=note.id, title=note.title, content=note.content, owner_id=note.owner_id).dict() for note in notes]
-    await redis.set(cache_key, json.dumps(result), ex=60)  # TTL 60 сек
-    return result
+    returning = session.bind.dialect.insert_returning
+    batches = iter_batches(file.file, format, settings.NOTES_IMPORT_BATCH_SIZE)
+    while (batch := await run_in_threadpool(next, batches, None)) is not None:
+        rows, batch_errors = batch
+        record_errors(report, batch_errors, settings.NOTES_IMPORT_MAX_ERRORS)
+        if rows:
+            last_seq = await reserve_seq(session, current_user.id, len(rows))
+            result = await session.execute(insert_statement(rows, current_user.id, last_seq, returning))
+            note_ids = result.scalars().all() if returning else []
+            await session.commit()
+            report["imported"] += len(rows)
+            if note_ids:
+                # ids looked up before they existed may be cached as 404s
+                await redis.delete(*(note_cache_key(current_user.id, note_id) for note_id in note_ids))
+    if report["imported"]:
+        await bump_notes_generation(redis, current_user.id)
+    return report
+
+@router.get("/batch")
+async def get_notes_batch(ids: str, current_user: User = Depends(get_user), session: AsyncSession = Depends(get_note_read_session)):
+    try:
+        note_ids = list(dict.fromkeys(int(note_id) for note_id in ids.split(",") if note_id.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a comma-separated list of integers")
+    if len(note_ids) > settings.NOTES_BATCH_MAX_IDS:
+        raise HTTPException(status_code=413, detail=f"At most {settings.NOTES_BATCH_MAX_IDS} ids per request")
+    if not note_ids:
+        return Response(content=b"[]", media_type="application/json")
+
+    # one MGET for the cached notes, one owner-scoped IN query for the rest
+    redis = await get_redis_bytes()
+    keys = [note_cache_key(current_user.id, note_id) for note_id in note_ids]
+    found = dict(zip(note_ids, await redis.mget(keys)))
+    misses = [note_id for note_id, value in found.items() if value is None]
+    if misses:
+        rows = await session.execute(select(*NOTE_COLUMNS).where(Note.owner_id == current_user.id, Note.id.in_(misses)))
+        pipe = redis.pipeline()
+        for row in rows:
+            found[row.id] = dump_json(row._asdict())
+            pipe.set(note_cache_key(current_user.id, row.id), found[row.id], ex=settings.NOTE_CACHE_TTL)
+        await pipe.execute()
+
+    # ids that don't exist, are negatively cached or belong to someone else are left out
+    body = b"[" + b",".join(found[note_id] for note_id in note_ids if found[note_id]) + b"]"
+    return Response(content=body, media_type="application/json")
+
+@router.post("/batch", response_model=List[NoteBatchResult])
+async def batch_notes(ops: List[NoteBatchOp], current_user: User = Depends(get_user), session: AsyncSession = Depends(get_note_session)):
+    if len(ops) > settings.NOTES_BATCH_MAX_OPS:
+        raise HTTPException(status_code=413, detail=f"At most {settings.NOTES_BATCH_MAX_OPS} operations per batch")
+
+    results: list[NoteBatchResult | None] = [None] * len(ops)
+    creates, updates, deletes, seen = [], {}, {}, set()
+    for i, op in enumerate(ops):
+        if op.op == "create":
+            if op.title is None or op.content is None:
+                results[i] = NoteBatchResult(op=op.op, status=400, detail="title and content are required")
+            else:
+                creates.append(i)
+        elif op.id is None:
+            results[i] = NoteBatchResult(op=op.op, status=400, detail="id is required")
+        elif op.id in seen:
+            results[i] = NoteBatchResult(op=op.op, id=op.id, status=400, detail="Note appears more than once in batch")
+        else:
+            seen.add(op.id)
+            (updates if op.op == "update" else deletes)[op.id] = i
+
+    # one IN lookup for every note the batch touches
+    existing = {}
+    if seen:
+        rows = await session.exec(select(Note).where(Note.owner_id == current_user.id, Note.id.in_(seen)))
+        existing = {note.id: NoteResponse(id=note.id, title=note.title, content=note.content, owner_id=note.owner_id) for note in rows}
+    for note_id, i in {**updates, **deletes}.items():
+        if note_id not in existing:
+            results[i] = NoteBatchResult(op=ops[i].op, id=note_id, status=404, detail="Note not found")
+
+    changed = []
+    for note_id, i in updates.items():
+        if note_id in existing:
+            note = existing[note_id].copy(update=ops[i].dict(include={"title", "content"}, exclude_none=True))
+            changed.append(note)
+            results[i] = NoteBatchResult(op="update", id=note_id, status=200, note=note)
+    removed = [note_id for note_id in deletes if note_id in existing]
+
+    # reserve one change number per write up front, then hand them out in order
+    total = len(creates) + len(changed) + len(removed)
+    if total:
+        seqs = itertools.count(await reserve_seq(session, current_user.id, total) - total + 1)
+    now = utcnow()
+
+    if creates:
+        rows = await session.execute(
+            insert(Note).returning(Note.id, sort_by_parameter_order=True),
+            [{"title": ops[i].title, "content": ops[i].content, "owner_id": current_user.id, "seq": next(seqs), "updated_at": now} for i in creates],
+        )
+        for i, note_id in zip(creates, rows.scalars()):
+            note = NoteResponse(id=note_id, title=ops[i].title, content=ops[i].content, owner_id=current_user.id)
+            results[i] = NoteBatchResult(op="create", id=note_id, status=201, note=note)
+
+    if changed:
+        # executemany UPDATE by primary key; ownership was checked by the lookup above
+        await session.execute(update(Note), [{"id": n.id, "title": n.title, "content": n.content, "seq": next(seqs), "updated_at": now} for n in changed])
+
+    if removed:
+        await session.execute(delete(Note).where(Note.owner_id == current_user.id, Note.id.in_(removed)))
+        await session.execute(insert(NoteTombstone), [{"owner_id": current_user.id, "note_id": note_id, "seq": next(seqs), "deleted_at": now} for note_id in removed])
+        for note_id in removed:
+            results[deletes[note_id]] = NoteBatchResult(op="delete", id=note_id, status=200, note=existing[note_id])
+
+    await session.commit()
+    if creates or changed or removed:
+        # write-through the per-note cache, then move the list generation on
+        redis = await get_redis_bytes()
+        pipe = redis.pipeline()
+        for result in results:
+            if result.status == 200 and result.op == "delete":
+                pipe.delete(note_cache_key(current_user.id, result.id))
+            elif result.status in (200, 201):
+                pipe.set(note_cache_key(current_user.id, result.id), dump_json(result.note.dict()), ex=settings.NOTE_CACHE_TTL)
+        await pipe.execute()
+        await bump_notes_generation(redis, current_user.id)
+    return results
+
+@router.get("/changes", response_model=NoteChanges)
+async def note_changes(since: int = 0, limit: int = Query(default=500, ge=1, le=5000), current_user: User = Depends(get_user), session: AsyncSession = Depends(get_note_read_session)):
+    # both lookups walk an (owner_id, seq) index, so cost follows churn, not library size
+    notes = (await session.exec(
+        select(Note).where(Note.owner_id == current_user.id, Note.seq > since).order_by(Note.seq).limit(limit)
+    )).all()
+    tombstones = (await session.exec(
+        select(NoteTombstone).where(NoteTombstone.owner_id == current_user.id, NoteTombstone.seq > since).order_by(NoteTombstone.seq).limit(limit)
+    )).all()
+
+    # merge by seq and cut at limit; anything past the last returned seq comes next call
+    merged = sorted([*notes, *tombstones], key=lambda item: item.seq)[:limit]
+    # more is left if either query was cut off, or if the merge itself dropped rows
+    has_more = len(notes) == limit or len(tombstones) == limit or len(notes) + len(tombstones) > limit
+    changes, deleted = [], []
+    for item in merged:
+        if isinstance(item, NoteTombstone):
+            deleted.append(item.note_id)
+        else:
+            changes.append(NoteChange(id=item.id, title=item.title, content=item.content, owner_id=item.owner_id, updated_at=item.updated_at, seq=item.seq))
+    return NoteChanges(changes=changes, deleted=deleted, since=merged[-1].seq if merged else since, has_more=has_more)
 
 @router.post("/create_note", response_model=NoteResponse)
-async def create(note: Note, current_user: User = Depends(get_user)):
+async def create(note: Note, current_user: User = Depends(get_user), session: AsyncSession = Depends(get_note_session)):
     note.owner_id = current_user.id
+    note.seq = await reserve_seq(session, current_user.id)
+    note.updated_at = utcnow()
     session.add(note)
-    session.commit()
-    session.refresh(note)
-    redis = await get_redis()
-    await redis.delete_pattern(f"notes:{current_user.id}:*")
-    return note
+    # the insert already hands back the id and sessions don't expire on commit, so no refresh
+    await session.commit()
+    created = NoteResponse(id=note.id, title=note.title, content=note.content, owner_id=note.owner_id)
+    redis = await get_redis_bytes()
+    # also replaces a negative entry if this id was looked up before it existed
+    await redis.set(note_cache_key(current_user.id, note.id), dump_json(created.dict()), ex=settings.NOTE_CACHE_TTL)
+    await bump_notes_generation(redis, current_user.id)
+    return created
 
 @router.get("/note/{note_id}", response_model=NoteResponse)
-async def note(note_id: int, current_user: User = Depends(get_user)):
-    note = session.exec(select(Note).where(Note.id == note_id, Note.owner_id == current_user.id))
-    if not note:
+async def note(note_id: int, request: Request, current_user: User = Depends(get_user), session: AsyncSession = Depends(get_note_read_session)):
+    redis = await get_redis_bytes()
+    generation = await get_notes_generation(redis, current_user.id)
+    etag = make_etag("note", current_user.id, generation, note_id)
+    unchanged = not_modified(request, etag)
+    if unchanged:
+        return unchanged
+
+    # read-through; an empty value is a cached 404
+    key = note_cache_key(current_user.id, note_id)
+    body = await redis.get(key)
+    if body is None:
+        row = (await session.execute(select(*NOTE_COLUMNS).where(Note.id == note_id, Note.owner_id == current_user.id))).first()
+        if row:
+            body = dump_json(row._asdict())
+            await redis.set(key, body, ex=settings.NOTE_CACHE_TTL)
+        else:
+            body = b""
+            await redis.set(key, body, ex=settings.NOTE_NEGATIVE_CACHE_TTL)
+    if not body:
         raise HTTPException(status_code=404, detail="Note not found")
-    return NoteResponse(id=note.id, title=note.title, content=note.content, owner_id = note.owner_id)
+    return Response(content=body, media_type="application/json", headers={"ETag": etag, "Cache-Control": NOTES_CACHE_CONTROL})
 
 @router.put("/note/{note_id}", response_model=NoteResponse)
-async def update_note(note_id: int, note_update: NoteUpdate, current_user: User = Depends(get_user)):
-    existing_note = session.exec(select(Note).where(Note.id == note_id, Note.owner_id == current_user.id)).first()
-    if not existing_note:
-        raise HTTPException(status_code=404, detail="Note not found")
+async def update_note(note_id: int, note_update: NoteUpdate, current_user: User = Depends(get_user), session: AsyncSession = Depends(get_note_session)):
     update_data = note_update.dict(exclude_unset=True)
-    for key, value in update_data.items():
-        setattr(existing_note, key, value)
-    session.add(existing_note)
-    session.commit()
-    session.refresh(existing_note)
-    redis = await get_redis()
-    await redis.delete_pattern(f"notes:{current_user.id}:*")
-    return NoteResponse(id=existing_note.id, title=existing_note.title, content=existing_note.content, owner_id=existing_note.owner_id)
+    owned = (Note.id == note_id, Note.owner_id == current_user.id)
+    if not update_data:
+        row = (await session.execute(select(*NOTE_COLUMNS).where(*owned))).first()
+    elif session.bind.dialect.update_returning:
+        # ownership-filtered UPDATE ... RETURNING: one round trip instead of select + update + refresh
+        seq = await reserve_seq(session, current_user.id)
+        row = (await session.execute(
+            update(Note).where(*owned).values(**update_data, seq=seq, updated_at=utcnow()).returning(*NOTE_COLUMNS),
+            execution_options={"synchronize_session": False},
+        )).first()
+    else:
+        # SQLite before 3.35 has no RETURNING
+        row = (await session.execute(select(*NOTE_COLUMNS).where(*owned))).first()
+        if row:
+            seq = await reserve_seq(session, current_user.id)
+            await session.execute(update(Note).where(*owned).values(**update_data, seq=seq, updated_at=utcnow()), execution_options={"synchronize_session": False})
+    if not row:
+        raise HTTPException(status_code=404, detail="Note not found")
+    await session.commit()
+    updated = NoteResponse(**{**row._asdict(), **update_data})
+    if update_data:
+        redis = await get_redis_bytes()
+        await redis.set(note_cache_key(current_user.id, note_id), dump_json(updated.dict()), ex=settings.NOTE_CACHE_TTL)
+        await bump_notes_generation(redis, current_user.id)
+    return updated
 
 @router.delete("/note/{note_id}", response_model=NoteResponse)
-async def delete_note(note_id: int, current_user: User = Depends(get_user)):
-    existing_note = session.exec(select(Note).where(Note.id == note_id, Note.owner_id == current_user.id)).first()
-    if not existing_note:
+async def delete_note(note_id: int, current_user: User = Depends(get_user), session: AsyncSession = Depends(get_note_session)):
+    owned = (Note.id == note_id, Note.owner_id == current_user.id)
+    # take the owner's sequence row before the note row, same lock order as update_note
+    seq = await reserve_seq(session, current_user.id)
+    if session.bind.dialect.delete_returning:
+        row = (await session.execute(
+            delete(Note).where(*owned).returning(*NOTE_COLUMNS),
+            execution_options={"synchronize_session": False},
+        )).first()
+    else:
+        row = (await session.execute(select(*NOTE_COLUMNS).where(*owned))).first()
+        if row:
+            await session.execute(delete(Note).where(*owned), execution_options={"synchronize_session": False})
+    if not row:
         raise HTTPException(status_code=404, detail="Note not found")
-    session.delete(existing_note)
-    session.commit()
-    redis = await get_redis()
-    await redis.delete_pattern(f"notes:{current_user.id}:*")
-    return NoteResponse(id=existing_note.id, title=existing_note.title, content=existing_note.content, owner_id=existing_note.owner_id)
\ No newline at end of file
+    # tombstone so delta sync clients learn about the delete
+    session.add(NoteTombstone(owner_id=current_user.id, note_id=note_id, seq=seq))
+    await session.commit()
+    redis = await get_redis_bytes()
+    await redis.delete(note_cache_key(current_user.id, note_id))
+    await bump_notes_generation(redis, current_user.id)
+    return NoteResponse(**row._asdict())
\ No newline at end of file
@@ -0,0 +1,113 @@
+# Moves owners onto the shard jump hash now assigns them after NOTES_SHARD_URLS grew.
+#
+#   python rebalance_shards.py            # dry run: print who would move where
+#   python rebalance_shards.py --apply
+#
+# Start the app once with the new shard list first so every shard has its
+# tables and id range. Pause note writes while this runs: an owner is copied,
+# then deleted from the old shard, and the app must already route them to the
+# new one. Each owner moves in its own transaction pair and a copy left on the
+# target by an interrupted run is replaced, so the run can simply be started
+# again. An owner who already has notes or deletes on the target that the old
+# shard doesn't know about is skipped and reported; those need merging by hand.
+import argparse
+from collections import Counter
+
+from sqlalchemy import Integer, column, delete, insert, select, table
+
+from config import settings
+from note_changes import note_sequence
+from note_import import note_table
+from shards import note_shards
+
+note_tombstone = table(
+    "note_tombstone", column("owner_id", Integer), column("note_id", Integer), column("seq", Integer), column("deleted_at"),
+)
+OWNED_TABLES = (note_table, note_tombstone, note_sequence)
+# what identifies a copied row: note ids are kept, tombstone ids are not
+COPY_KEYS = ((note_table, note_table.c.id), (note_tombstone, note_tombstone.c.note_id))
+
+
+def owners(engine) -> list[int]:
+    query = select(note_sequence.c.owner_id).union(select(note_table.c.owner_id), select(note_tombstone.c.owner_id))
+    with engine.connect() as conn:
+        return sorted(conn.execute(query).scalars())
+
+
+def foreign_rows(src, dst, owner_id: int) -> int:
+    # rows the app wrote on the target once it routed the owner there; a copy
+    # from an interrupted run only holds notes and deletes the source has too
+    count = 0
+    for owned, key in COPY_KEYS:
+        query = select(key).where(owned.c.owner_id == owner_id)
+        count += len(set(dst.execute(query).scalars()) - set(src.execute(query).scalars()))
+    return count
+
+
+def move_owner(source, target, owner_id: int) -> int | None:
+    moved = 0
+    # the target transaction commits first; the rows leave the source only after that
+    with source.begin() as src, target.begin() as dst:
+        # holds the owner's counter so a stray write to the old shard waits for the move
+        src.execute(select(note_sequence.c.value).where(note_sequence.c.owner_id == owner_id).with_for_update())
+        if foreign_rows(src, dst, owner_id):
+            return None
+        # anything left for the owner on the target is an earlier partial copy
+        for owned in OWNED_TABLES:
+            dst.execute(delete(owned).where(owned.c.owner_id == owner_id))
+        for owned in OWNED_TABLES:
+            # note ids are kept; tombstone ids are local and get reassigned
+            rows = src.execution_options(yield_per=settings.NOTES_EXPORT_BATCH_SIZE).execute(
+                select(*owned.c).where(owned.c.owner_id == owner_id)
+            )
+            for batch in rows.partitions():
+                dst.execute(insert(owned), [row._asdict() for row in batch])
+                if owned is note_table:
+                    moved += len(batch)
+        for owned in OWNED_TABLES:
+            src.execute(delete(owned).where(owned.c.owner_id == owner_id))
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--apply", action="store_true", help="move the rows instead of printing the plan")
+    args = parser.parse_args()
+
+    if not note_shards.sharded:
+        raise SystemExit("NOTES_SHARD_URLS is empty; notes live on the primary")
+
+    totals = Counter()
+    skipped = 0
+    for index, shard in enumerate(note_shards.shards):
+        for owner_id in owners(shard["engine"]):
+            target = note_shards.index(owner_id)
+            if target == index:
+                continue
+            target_engine = note_shards.shards[target]["engine"]
+            if not args.apply:
+                with shard["engine"].connect() as src, target_engine.connect() as dst:
+                    conflicts = foreign_rows(src, dst, owner_id)
+                if conflicts:
+                    print(f"owner {owner_id}: shard {index} -> {target}, will be skipped: {conflicts} rows already on the target")
+                    skipped += 1
+                    continue
+                print(f"owner {owner_id}: shard {index} -> {target}")
+                totals[target] += 1
+                continue
+            moved = move_owner(shard["engine"], target_engine, owner_id)
+            if moved is None:
+                print(f"owner {owner_id}: shard {index} -> {target} skipped, the target has writes the source doesn't")
+                skipped += 1
+                continue
+            print(f"owner {owner_id}: shard {index} -> {target}, {moved} notes")
+            totals[target] += 1
+
+    for target, count in sorted(totals.items()):
+        print(f"shard {target}: {count} owners {'moved in' if args.apply else 'to move in'}")
+    if skipped:
+        raise SystemExit(f"{skipped} owners {'were' if args.apply else 'would be'} skipped and need merging by hand")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,17 @@
-import aioredis
+from redis import asyncio as aioredis
 import asyncio
+import math
+import random
+import time
+import uuid
+from collections import OrderedDict
+from prometheus_client import Counter, Gauge
 from config import settings
+from db import mark_written
 REDIS_URL = settings.REDIS_URL
 
 redis = None
+redis_bytes = None
 
 async def get_redis():
     global redis
@@ -11,9 +19,225 @@ async def get_redis():
         redis = await aioredis.from_url(REDIS_URL, decode_responses=True)
     return redis
 
-# monkey-patch aioredis for delete_pattern (helper)
-async def delete_pattern(redis, pattern):
-    keys = await redis.keys(pattern)
-    if keys:
-        await redis.delete(*keys)
-aioredis.Redis.delete_pattern = delete_pattern
+# raw client for caches that store finished response bodies
+async def get_redis_bytes():
+    global redis_bytes
+    if redis_bytes is None:
+        redis_bytes = await aioredis.from_url(REDIS_URL, decode_responses=False)
+    return redis_bytes
+
+INVALIDATION_CHANNEL = "notes:invalidate"
+
+
+class LocalCache:
+    # per-worker LRU in front of redis, bounded by entry count and total bytes
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[str, tuple[float, object, int, object]] = OrderedDict()
+        self._by_tag: dict[object, set[str]] = {}
+
+    def _drop(self, key: str):
+        _, _, size, tag = self._entries.pop(key)
+        self.size -= size
+        keys = self._by_tag.get(tag)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_tag[tag]
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: str, value, ttl: float, tag=None):
+        size = len(value) if isinstance(value, (str, bytes)) else 64
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (time.monotonic() + ttl, value, size, tag)
+        self._by_tag.setdefault(tag, set()).add(key)
+        self.size += size
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+        LOCAL_CACHE_BYTES.set(self.size)
+
+    def evict_tag(self, tag):
+        for key in list(self._by_tag.get(tag, ())):
+            self._drop(key)
+        LOCAL_CACHE_BYTES.set(self.size)
+
+    def clear(self):
+        self._entries.clear()
+        self._by_tag.clear()
+        self.size = 0
+        LOCAL_CACHE_BYTES.set(0)
+
+
+LOCAL_CACHE_BYTES = Gauge("notes_local_cache_bytes", "Bytes held by this worker's in-process notes cache")
+LOCAL_CACHE_HITS = Counter("notes_local_cache_hits_total", "Notes cache hits served from process memory")
+
+local_cache = LocalCache(settings.NOTES_LOCAL_CACHE_ENTRIES, settings.NOTES_LOCAL_CACHE_BYTES)
+
+
+# notes cache keys embed a per-user generation; writes just INCR it and
+# stale entries age out through their TTL instead of being scanned and deleted
+def notes_generation_key(user_id: int) -> str:
+    return f"notes:gen:{user_id}"
+
+# The generation also makes the strong etags, and redis may lose the key (restart,
+# eviction). Starting again from 0 would hand out old values for different data,
+# so a missing counter restarts from a random base instead.
+def notes_generation_base() -> int:
+    return random.getrandbits(48)
+
+async def get_notes_generation(redis, user_id: int) -> int:
+    key = notes_generation_key(user_id)
+    generation = local_cache.get(key)
+    if generation is None:
+        pipe = redis.pipeline()
+        pipe.set(key, notes_generation_base(), nx=True)
+        pipe.get(key)
+        _, generation = await pipe.execute()
+        generation = int(generation)
+        local_cache.set(key, generation, settings.NOTES_LOCAL_CACHE_TTL, tag=user_id)
+    return generation
+
+# single notes are cached per owner and id, outside the generation scheme,
+# and are dropped explicitly by the handlers that change them
+def note_cache_key(user_id: int, note_id: int) -> str:
+    return f"note:{user_id}:{note_id}"
+
+async def bump_notes_generation(redis, user_id: int) -> int:
+    local_cache.evict_tag(user_id)
+    mark_written(user_id)
+    pipe = redis.pipeline()
+    pipe.set(notes_generation_key(user_id), notes_generation_base(), nx=True)
+    pipe.incr(notes_generation_key(user_id))
+    pipe.publish(INVALIDATION_CHANNEL, user_id)
+    _, generation, _ = await pipe.execute()
+    return generation
+
+async def listen_for_invalidations():
+    # evict other workers' writes from this worker's memory tier
+    while True:
+        try:
+            pubsub = (await get_redis()).pubsub()
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            # anything published while we were disconnected is lost
+            local_cache.clear()
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    # every note write is broadcast here, which also makes the
+                    # writer read from the primary on this worker for a while
+                    user_id = int(message["data"])
+                    local_cache.evict_tag(user_id)
+                    mark_written(user_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Redis error in cache invalidation listener: {e}")
+            local_cache.clear()
+            await asyncio.sleep(1)
+
+
+CACHE_MISSES = Counter("notes_cache_misses_total", "Notes cache misses that ran the query")
+CACHE_COALESCED = Counter("notes_cache_coalesced_total", "Requests that waited for another request's result", ["scope"])
+CACHE_LOCK_TIMEOUTS = Counter("notes_cache_lock_timeouts_total", "Waiters that gave up on the fill lock and computed themselves")
+CACHE_EARLY_REFRESHES = Counter("notes_cache_early_refreshes_total", "Entries recomputed before their TTL ran out")
+
+RELEASE_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# one fill task per key in this process; other coroutines await it
+_inflight: dict[str, asyncio.Task] = {}
+
+
+def _refresh_early(pttl: int, delta: float) -> bool:
+    # XFetch: the closer to expiry and the slower the fill, the likelier a refresh
+    beta = settings.CACHE_EARLY_REFRESH_BETA
+    if beta <= 0 or pttl <= 0 or delta <= 0:
+        return False
+    return -delta * beta * math.log(1 - random.random()) >= pttl / 1000
+
+
+async def _wait_for_fill(redis, key: str):
+    deadline = time.monotonic() + settings.CACHE_LOCK_WAIT_MS / 1000
+    while time.monotonic() < deadline:
+        await asyncio.sleep(settings.CACHE_LOCK_POLL_MS / 1000)
+        value = await redis.get(key)
+        if value is not None:
+            return value
+    CACHE_LOCK_TIMEOUTS.inc()
+    return None
+
+
+async def _fill(redis, key: str, compute, ttl: int, stale):
+    lock_key = f"lock:{key}"
+    token = uuid.uuid4().hex
+    locked = await redis.set(lock_key, token, nx=True, px=settings.CACHE_LOCK_TTL_MS)
+    if not locked:
+        # another worker is filling; serve the old value if we still have it
+        if stale is not None:
+            return stale
+        CACHE_COALESCED.labels(scope="redis").inc()
+        value = await _wait_for_fill(redis, key)
+        if value is not None:
+            return value
+
+    CACHE_MISSES.inc()
+    started = time.monotonic()
+    try:
+        value = await compute()
+        pipe = redis.pipeline()
+        pipe.set(key, value, ex=ttl)
+        pipe.set(f"{key}:delta", time.monotonic() - started, ex=ttl)
+        await pipe.execute()
+    finally:
+        if locked:
+            await redis.eval(RELEASE_LOCK, 1, lock_key, token)
+    return value
+
+
+# read-through with single-flight: compute() runs at most once per key across workers
+async def cached(redis, key: str, compute, ttl: int, tag=None):
+    value = local_cache.get(key)
+    if value is not None:
+        LOCAL_CACHE_HITS.inc()
+        return value
+
+    pipe = redis.pipeline()
+    pipe.get(key)
+    pipe.pttl(key)
+    pipe.get(f"{key}:delta")
+    value, pttl, delta = await pipe.execute()
+    if value is not None:
+        if not _refresh_early(pttl, float(delta or 0)):
+            local_cache.set(key, value, min(pttl / 1000, settings.NOTES_LOCAL_CACHE_TTL), tag)
+            return value
+        CACHE_EARLY_REFRESHES.inc()
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fill(redis, key, compute, ttl, value))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        CACHE_COALESCED.labels(scope="local").inc()
+        if value is not None:
+            return value
+    value = await asyncio.shield(task)
+    local_cache.set(key, value, settings.NOTES_LOCAL_CACHE_TTL, tag)
+    return value
@@ -0,0 +1,66 @@
+from sqlalchemy import column, func, literal_column, table, text
+
+# Databases built by create_all don't get the search objects from the alembic
+# migration, so they are set up here as well; every statement is safe to rerun.
+POSTGRES_SEARCH_DDL = [
+    # stored generated column, so every insert/update keeps it in sync
+    """ALTER TABLE note ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(content, '')), 'B')
+    ) STORED""",
+    "CREATE INDEX IF NOT EXISTS ix_note_search_vector ON note USING gin (search_vector)",
+]
+
+SQLITE_FTS_DDL = [
+    "CREATE VIRTUAL TABLE note_fts USING fts5(title, content, content='note', content_rowid='id')",
+    """CREATE TRIGGER note_fts_ai AFTER INSERT ON note BEGIN
+        INSERT INTO note_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+    """CREATE TRIGGER note_fts_ad AFTER DELETE ON note BEGIN
+        INSERT INTO note_fts(note_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+    END""",
+    """CREATE TRIGGER note_fts_au AFTER UPDATE ON note BEGIN
+        INSERT INTO note_fts(note_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO note_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+    "INSERT INTO note_fts(note_fts) VALUES ('rebuild')",
+]
+
+note_fts = table("note_fts", column("rowid"), column("rank"))
+
+
+def ensure_search_index(engine):
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as conn:
+            for statement in POSTGRES_SEARCH_DDL:
+                conn.execute(text(statement))
+        return
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as conn:
+        exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'note_fts'")).first()
+        if exists:
+            return
+        for statement in SQLITE_FTS_DDL:
+            conn.execute(text(statement))
+
+
+def fts5_query(term: str) -> str:
+    # quote every word so user input can't hit FTS5 query syntax
+    words = term.split()
+    return " ".join('"' + word.replace('"', '""') + '"' for word in words)
+
+
+def apply_search(query, note_model, term: str, dialect: str):
+    if dialect == "postgresql":
+        tsquery = func.websearch_to_tsquery("simple", term)
+        vector = literal_column("note.search_vector")
+        return query.where(vector.op("@@")(tsquery)).order_by(func.ts_rank(vector, tsquery).desc(), note_model.id)
+    if dialect == "sqlite":
+        return (
+            query.join(note_fts, note_fts.c.rowid == note_model.id)
+            .where(text("note_fts MATCH :fts_term").bindparams(fts_term=fts5_query(term)))
+            .order_by(note_fts.c.rank, note_model.id)
+        )
+    return query.where(note_model.title.ilike(f"%{term}%") | note_model.content.ilike(f"%{term}%")).order_by(note_model.id)
@@ -0,0 +1,74 @@
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlmodel import create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import db
+from config import settings
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    # Lamping & Veach jump consistent hash: growing from n to n + 1 buckets only
+    # moves ~1/(n + 1) of the keys, and all of them onto the new bucket
+    key &= 0xFFFFFFFFFFFFFFFF
+    bucket, j = -1, 0
+    while j < buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+class ShardRouter:
+    # notes, note_sequence and note_tombstone are partitioned by owner_id;
+    # users stay on the primary. Without NOTES_SHARD_URLS the primary is the only shard.
+    def __init__(self, urls: list[str]):
+        self.sharded = bool(urls)
+        if not self.sharded:
+            self.shards = [{"url": settings.DATABASE_URL, "engine": db.engine, "session_maker": db.async_session_maker}]
+            return
+        self.shards = []
+        for url in urls:
+            async_engine = create_async_engine(db.async_url(url), echo=settings.DB_ECHO, **db.engine_options(url))
+            self.shards.append({
+                "url": url,
+                "engine": create_engine(url, echo=settings.DB_ECHO),
+                "session_maker": async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False),
+            })
+
+    def index(self, owner_id: int) -> int:
+        return jump_hash(owner_id, len(self.shards))
+
+    def engine(self, owner_id: int):
+        return self.shards[self.index(owner_id)]["engine"]
+
+    def session_maker(self, owner_id: int):
+        return self.shards[self.index(owner_id)]["session_maker"]
+
+    def read_session_maker(self, owner_id: int):
+        # replicas follow the primary, so they only serve notes while it is the single shard
+        if not self.sharded:
+            return db.read_session_maker(owner_id)
+        return self.session_maker(owner_id)
+
+
+note_shards = ShardRouter(settings.NOTES_SHARD_URLS)
+
+
+def reserve_id_range(engine, index: int):
+    # note ids must stay unique across shards so an owner can be moved with its ids intact;
+    # shard k hands out ids from k * NOTES_SHARD_ID_SPAN upwards
+    floor = index * settings.NOTES_SHARD_ID_SPAN
+    if not floor:
+        return
+    with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            conn.execute(
+                text("SELECT setval(pg_get_serial_sequence('note', 'id'), GREATEST(:floor, (SELECT coalesce(max(id), 0) FROM note)))"),
+                {"floor": floor},
+            )
+        elif engine.dialect.name == "sqlite":
+            # the note table is AUTOINCREMENT, so its counter lives in sqlite_sequence
+            updated = conn.execute(text("UPDATE sqlite_sequence SET seq = max(seq, :floor) WHERE name = 'note'"), {"floor": floor})
+            if not updated.rowcount:
+                conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('note', :floor)"), {"floor": floor})
@@ -0,0 +1,94 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# settings are read once at import, so the test environment goes in before main is imported
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmp}/test.db")
+os.environ.setdefault("CELERY_BROKER_URL", "redis://localhost:6379/0")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+os.environ.setdefault("DB_ECHO", "false")
+os.environ.setdefault("NOTES_IMPORT_DIR", f"{_tmp}/imports")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# note_url and main import each other, and main has to be loaded first
+import main  # noqa: E402,F401
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    from main import app
+
+    with TestClient(app) as client:
+        yield client
+
+
+class MemoryRedis:
+    # just the commands the notes cache uses, kept in a dict; expiry is ignored
+    def __init__(self):
+        self.data = {}
+        self.published = []
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    async def set(self, key, value, ex=None, px=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value if isinstance(value, bytes) else str(value).encode()
+        return True
+
+    async def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    async def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+        return int(self.data[key])
+
+    async def publish(self, channel, message):
+        self.published.append((channel, message))
+        return 0
+
+    async def pttl(self, key):
+        return 60_000 if key in self.data else -2
+
+    async def eval(self, script, numkeys, key, token):
+        # only the lock release script runs through eval
+        if self.data.get(key) == token.encode():
+            return await self.delete(key)
+        return 0
+
+    def pipeline(self):
+        return MemoryPipeline(self)
+
+
+class MemoryPipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.calls.append((getattr(self.redis, name), args, kwargs))
+        return queue
+
+    async def execute(self):
+        return [await method(*args, **kwargs) for method, args, kwargs in self.calls]
+
+
+@pytest.fixture
+def memory_redis(monkeypatch):
+    import redis_client
+
+    redis = MemoryRedis()
+    monkeypatch.setattr(redis_client, "redis_bytes", redis)
+    redis_client.local_cache.clear()
+    yield redis
+    redis_client.local_cache.clear()
@@ -0,0 +1,34 @@
+import asyncio
+import time
+
+from sqlmodel import Session
+
+
+def test_role_change_invalidates_on_commit(client):
+    from main import User, engine, principal_cache
+
+    with Session(engine) as session:
+        user = User(username="demoted", password="x", role="admin")
+        session.add(user)
+        session.commit()
+        principal_cache._set_local("demoted-token", {"id": user.id, "username": "demoted", "role": "admin"}, time.time() + 60)
+
+        user.role = "user"
+        session.flush()
+        # not committed yet, so other requests still see the admin row
+        assert principal_cache._get_local("demoted-token") is not None
+        session.commit()
+        assert principal_cache._get_local("demoted-token") is None
+
+
+def test_read_before_invalidation_is_not_cached():
+    from auth_cache import PrincipalCache
+
+    cache = PrincipalCache(100, 60)
+    read_at = time.time()
+    cache.invalidate_user_local(1)
+    asyncio.run(cache.set("token", {"id": 1, "username": "a", "role": "admin"}, time.time() + 60, read_at))
+    assert cache._get_local("token") is None
+
+    asyncio.run(cache.set("token", {"id": 1, "username": "a", "role": "user"}, time.time() + 60, read_at + 1))
+    assert cache._get_local("token")["role"] == "user"
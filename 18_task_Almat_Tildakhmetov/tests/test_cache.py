@@ -0,0 +1,49 @@
+import asyncio
+
+from redis_client import LocalCache, cached
+
+
+def test_local_cache_is_bounded_by_bytes_and_evicts_by_tag():
+    cache = LocalCache(max_entries=10, max_bytes=10)
+    cache.set("a", b"12345", 60, tag=1)
+    cache.set("b", b"12345", 60, tag=2)
+    cache.set("c", b"123", 60, tag=2)
+
+    # the oldest entry goes to make room
+    assert cache.get("a") is None
+    assert cache.size == 8
+    cache.evict_tag(2)
+    assert cache.get("b") is None and cache.get("c") is None
+    assert cache.size == 0
+
+
+def test_cached_runs_one_fill_for_concurrent_misses(memory_redis):
+    calls = 0
+
+    async def compute():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return b"page"
+
+    async def run():
+        return await asyncio.gather(*(cached(memory_redis, "notes:1:g1", compute, 60, tag=1) for _ in range(5)))
+
+    assert asyncio.run(run()) == [b"page"] * 5
+    assert calls == 1
+    assert memory_redis.data["notes:1:g1"] == b"page"
+    # the fill lock is released
+    assert "lock:notes:1:g1" not in memory_redis.data
+
+
+def test_cached_serves_from_memory_after_a_fill(memory_redis):
+    async def compute():
+        return b"page"
+
+    asyncio.run(cached(memory_redis, "notes:1:g1", compute, 60, tag=1))
+    memory_redis.data.clear()
+
+    async def fail():
+        raise AssertionError("should have been served from the local cache")
+
+    assert asyncio.run(cached(memory_redis, "notes:1:g1", fail, 60, tag=1)) == b"page"
@@ -0,0 +1,20 @@
+import asyncio
+
+from mw import ConcurrencyLimit
+
+
+def test_streamed_body_is_not_sampled_as_latency():
+    async def streaming_app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await asyncio.sleep(0.2)
+        await send({"type": "http.response.body", "body": b"done"})
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    limit = ConcurrencyLimit(streaming_app, skip_paths=[])
+    asyncio.run(limit({"type": "http", "path": "/notes/export", "method": "GET"}, receive, send))
+    assert limit.limiter.short_rtt < 0.1
@@ -0,0 +1,57 @@
+from sqlmodel import Session, select
+
+
+def seed_user(username: str) -> tuple[int, int, dict]:
+    from main import Note, NoteSequence, User, create_token, engine
+
+    with Session(engine) as session:
+        user = User(username=username, password="x")
+        session.add(user)
+        session.commit()
+        note = Note(title="old", content="c", owner_id=user.id, seq=1)
+        session.add(note)
+        session.add(NoteSequence(owner_id=user.id, value=1))
+        session.commit()
+        return user.id, note.id, {"Authorization": f"Bearer {create_token({'sub': username})}"}
+
+
+def test_batch_mixes_results_and_numbers_writes_in_order(client, memory_redis):
+    from main import Note, NoteSequence, NoteTombstone, engine
+
+    user_id, note_id, headers = seed_user("batch")
+    ops = [
+        {"op": "update", "id": note_id, "title": "new"},
+        {"op": "create", "title": "a", "content": "c"},
+        {"op": "delete", "id": note_id},
+        {"op": "delete", "id": 999_999},
+        {"op": "create", "title": "b"},
+        {"op": "update"},
+    ]
+    results = client.post("/notes/batch", json=ops, headers=headers).json()
+
+    assert [result["status"] for result in results] == [200, 201, 400, 404, 400, 400]
+    assert results[0]["note"]["title"] == "new"
+    assert results[2]["detail"] == "Note appears more than once in batch"
+    created_id = results[1]["id"]
+
+    with Session(engine) as session:
+        # one number per write: the create first, then the update
+        assert session.get(Note, created_id).seq == 2
+        assert session.get(Note, note_id).seq == 3
+        assert session.get(Note, note_id).title == "new"
+        assert session.exec(select(NoteTombstone).where(NoteTombstone.owner_id == user_id)).all() == []
+        assert session.get(NoteSequence, user_id).value == 3
+
+
+def test_batch_delete_leaves_a_tombstone(client, memory_redis):
+    from main import NoteSequence, NoteTombstone, engine
+
+    user_id, note_id, headers = seed_user("batch-delete")
+    results = client.post("/notes/batch", json=[{"op": "delete", "id": note_id}, {"op": "delete", "id": 999_999}], headers=headers).json()
+
+    assert [result["status"] for result in results] == [200, 404]
+    with Session(engine) as session:
+        tombstone = session.exec(select(NoteTombstone).where(NoteTombstone.owner_id == user_id)).one()
+        assert (tombstone.note_id, tombstone.seq) == (note_id, 2)
+        assert session.get(NoteSequence, user_id).value == 2
+    assert memory_redis.published
@@ -0,0 +1,37 @@
+from sqlmodel import Session
+
+
+def seed_user(username: str) -> tuple[int, dict]:
+    from main import Note, NoteSequence, NoteTombstone, User, create_token, engine
+
+    with Session(engine) as session:
+        user = User(username=username, password="x")
+        session.add(user)
+        session.commit()
+        # three live notes (seq 1, 3, 5) and three deletes (seq 2, 4, 6)
+        for seq in (1, 3, 5):
+            session.add(Note(title=f"n{seq}", content="c", owner_id=user.id, seq=seq))
+        for seq in (2, 4, 6):
+            session.add(NoteTombstone(owner_id=user.id, note_id=100 + seq, seq=seq))
+        session.add(NoteSequence(owner_id=user.id, value=6))
+        session.commit()
+        user_id = user.id
+    return user_id, {"Authorization": f"Bearer {create_token({'sub': username})}"}
+
+
+def test_changes_page_cut_by_merge_reports_more(client):
+    _, headers = seed_user("changes")
+
+    first = client.get("/notes/changes", params={"since": 0, "limit": 4}, headers=headers).json()
+    assert first["since"] == 4
+    assert first["has_more"] is True
+
+    second = client.get("/notes/changes", params={"since": first["since"], "limit": 4}, headers=headers).json()
+    assert [change["seq"] for change in second["changes"]] == [5]
+    assert second["deleted"] == [106]
+    assert second["has_more"] is False
+
+
+def test_changes_rejects_zero_limit(client):
+    _, headers = seed_user("changes-zero")
+    assert client.get("/notes/changes", params={"limit": 0}, headers=headers).status_code == 422
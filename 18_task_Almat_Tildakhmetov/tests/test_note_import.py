@@ -0,0 +1,41 @@
+import io
+
+from note_import import iter_batches, parse_row, record_errors
+
+
+def batches(text: str, fmt: str, batch_size: int = 2):
+    return list(iter_batches(io.BytesIO(text.encode()), fmt, batch_size))
+
+
+def test_parse_row_requires_title_and_content():
+    assert parse_row({"title": "t", "content": ""}) == {"title": "t", "content": ""}
+    assert parse_row({"title": "", "content": "c"}) == "title is required"
+    assert parse_row({"title": "t"}) == "content is required"
+    assert parse_row(["t", "c"]) == "expected an object with title and content"
+
+
+def test_ndjson_batches_keep_line_numbers_of_errors():
+    text = '{"title": "a", "content": "1"}\n\nnot json\n{"title": "b", "content": "2"}\n{"title": "c", "content": "3"}\n{"content": "4"}\n'
+    result = batches(text, "ndjson")
+
+    assert [[row["title"] for row in rows] for rows, _ in result] == [["a", "b"], ["c"]]
+    errors = [error for _, batch_errors in result for error in batch_errors]
+    assert [error["line"] for error in errors] == [3, 6]
+    assert errors[0]["error"].startswith("invalid JSON")
+
+
+def test_csv_lines_count_the_header():
+    text = "title,content\na,1\n,2\n"
+    (rows, errors), = batches(text, "csv", batch_size=10)
+
+    assert rows == [{"title": "a", "content": "1"}]
+    assert errors == [{"line": 3, "error": "title is required"}]
+
+
+def test_error_details_are_capped_but_all_counted():
+    report = {"imported": 0, "error_count": 0, "errors": []}
+    record_errors(report, [{"line": i, "error": "x"} for i in range(3)], max_errors=4)
+    record_errors(report, [{"line": i, "error": "x"} for i in range(3, 6)], max_errors=4)
+
+    assert report["error_count"] == 6
+    assert [error["line"] for error in report["errors"]] == [0, 1, 2, 3]
@@ -0,0 +1,34 @@
+import base64
+
+import pytest
+from sqlmodel import Session
+
+
+def test_notes_rejects_zero_limit(client):
+    from main import User, create_token, engine
+
+    with Session(engine) as session:
+        session.add(User(username="notes-limit", password="x"))
+        session.commit()
+    headers = {"Authorization": f"Bearer {create_token({'sub': 'notes-limit'})}"}
+    assert client.get("/notes/notes", params={"limit": 0}, headers=headers).status_code == 422
+
+
+def encode(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+
+def test_cursor_round_trip():
+    from note_url import decode_cursor, encode_cursor
+
+    assert decode_cursor(encode_cursor(7, 123)) == (7, 123)
+
+
+def test_malformed_cursor_is_a_400():
+    from main import HTTPException
+    from note_url import decode_cursor
+
+    for cursor in ("not-base64!", encode("7"), encode("1:2:3"), encode("a:b")):
+        with pytest.raises(HTTPException) as error:
+            decode_cursor(cursor)
+        assert error.value.status_code == 400
@@ -0,0 +1,59 @@
+import asyncio
+
+from mw import LocalRateLimiter
+
+
+def test_local_limiter_falls_back_to_local_buckets_when_sync_fails():
+    async def run():
+        # no redis behind it, so every sync fails
+        limiter = LocalRateLimiter(None, 100, 60_000, 3_600_000, 10)
+        allowed = [(await limiter.hit("ip:1"))[0] for _ in range(11)]
+        assert allowed == [True] * 10 + [False]
+
+        try:
+            await limiter.sync()
+        except Exception:
+            pass
+        allowed = [(await limiter.hit("ip:1"))[0] for _ in range(100)]
+        limiter.task.cancel()
+        # the local bucket still holds the 90 tokens left of the limit
+        assert allowed == [True] * 90 + [False] * 10
+
+    asyncio.run(run())
+
+
+def test_local_limiter_pushes_pending_hits_and_takes_the_fleet_balance():
+    async def run():
+        limiter = LocalRateLimiter(None, 100, 60_000, 3_600_000, 10)
+        pushed = []
+
+        async def reconcile(keys, args):
+            pushed.append((keys, args))
+            # other workers spent 50 of this key's budget
+            return [100 - 50 - args[2]]
+
+        limiter.reconcile = reconcile
+        for _ in range(3):
+            await limiter.hit("ip:1", 2)
+        limiter.task.cancel()
+        await limiter.sync()
+
+        assert pushed == [(["rate_limit:token_bucket:ip:1"], [100, 60_000, 6])]
+        bucket = limiter.buckets["ip:1"]
+        assert (round(bucket[0]), bucket[2]) == (44, 0)
+        # nothing is pending any more, so the next sync has nothing new to push
+        await limiter.sync()
+        assert pushed[-1][1][2] == 0
+
+    asyncio.run(run())
+
+
+def test_local_limiter_lets_one_charge_above_the_overshoot_through():
+    async def run():
+        limiter = LocalRateLimiter(None, 100, 60_000, 3_600_000, 10)
+        first = await limiter.hit("login", 25)
+        second = await limiter.hit("login", 25)
+        limiter.task.cancel()
+        return first[0], second[0]
+
+    assert asyncio.run(run()) == (True, False)
@@ -0,0 +1,53 @@
+from sqlalchemy import insert, select
+from sqlmodel import SQLModel, create_engine
+
+
+def shard(tmp_path, name):
+    from main import Note, NoteSequence, NoteTombstone
+
+    engine = create_engine(f"sqlite:///{tmp_path}/{name}.db")
+    SQLModel.metadata.create_all(engine, tables=[Note.__table__, NoteSequence.__table__, NoteTombstone.__table__])
+    return engine
+
+
+def add_notes(engine, owner_id, ids):
+    from note_changes import utcnow
+    from note_import import note_table
+
+    with engine.begin() as conn:
+        conn.execute(insert(note_table), [
+            {"id": i, "title": "t", "content": "c", "owner_id": owner_id, "seq": i, "updated_at": utcnow()} for i in ids
+        ])
+
+
+def note_ids(engine, owner_id):
+    from note_import import note_table
+
+    with engine.connect() as conn:
+        return sorted(conn.execute(select(note_table.c.id).where(note_table.c.owner_id == owner_id)).scalars())
+
+
+def test_move_replaces_a_partial_copy(tmp_path):
+    from rebalance_shards import move_owner
+
+    source, target = shard(tmp_path, "source"), shard(tmp_path, "target")
+    add_notes(source, 1, [1, 2, 3])
+    # an earlier run committed the copy but died before clearing the source
+    add_notes(target, 1, [1, 2, 3])
+
+    assert move_owner(source, target, 1) == 3
+    assert note_ids(source, 1) == []
+    assert note_ids(target, 1) == [1, 2, 3]
+
+
+def test_move_never_deletes_notes_written_on_the_target(tmp_path):
+    from rebalance_shards import move_owner
+
+    source, target = shard(tmp_path, "source"), shard(tmp_path, "target")
+    add_notes(source, 1, [1, 2])
+    # created through the app after it started routing the owner to the target
+    add_notes(target, 1, [1_000_001])
+
+    assert move_owner(source, target, 1) is None
+    assert note_ids(source, 1) == [1, 2]
+    assert note_ids(target, 1) == [1_000_001]
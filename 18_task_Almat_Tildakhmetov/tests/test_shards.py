@@ -0,0 +1,21 @@
+from collections import Counter
+
+from shards import jump_hash
+
+
+def test_jump_hash_is_stable_and_in_range():
+    assert [jump_hash(key, 1) for key in range(100)] == [0] * 100
+    assert all(0 <= jump_hash(key, 7) < 7 for key in range(1000))
+    assert [jump_hash(key, 7) for key in range(50)] == [jump_hash(key, 7) for key in range(50)]
+
+
+def test_growing_moves_keys_only_onto_the_new_bucket():
+    keys = range(10_000)
+    before = {key: jump_hash(key, 4) for key in keys}
+    after = {key: jump_hash(key, 5) for key in keys}
+
+    moved = [key for key in keys if before[key] != after[key]]
+    assert all(after[key] == 4 for key in moved)
+    # about 1/5 of the keys move, spread evenly over the five buckets
+    assert 1600 < len(moved) < 2400
+    assert all(1600 < count < 2400 for count in Counter(after.values()).values())
@@ -0,0 +1,18 @@
+def test_health(client):
+    response = client.get("/health")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ok"}
+
+
+def test_notes_require_auth(client):
+    assert client.get("/notes/notes").status_code == 401
+
+
+def test_unknown_user_is_rejected(client):
+    # goes through get_user's database lookup, so the tables must exist
+    from main import create_token
+
+    token = create_token({"sub": "nobody"})
+    response = client.get("/users/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 401
+    assert response.json()["detail"] == "User not found"